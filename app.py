@@ -1,21 +1,81 @@
+import os
+import uuid
 import configparser
 
-from celery import Celery
+from celery import Celery, chord, group
 from celery.schedules import crontab
+from celery.signals import worker_process_shutdown
 
-from periodic_tasks import updater, clean_up
+from periodic_tasks import updater, clean_up, claim_due_asins, merge_summaries
+from leases import acquire_lease, release_lease
+from db_engine import dispose_sync_engines
+from parse_pool import shutdown_parse_pool
+from metrics import new_run_id, log_event, dump
 
 
 CFG = configparser.ConfigParser()
 CFG.read('config.ini')
 BROKER_URL = CFG['credentials']['celery_broker_url']
+RESULT_BACKEND = CFG.get('credentials', 'celery_result_backend', fallback=None)
+ALWAYS_EAGER = CFG.getboolean('settings', 'celery_always_eager', fallback=False)
+UPDATER_SHARD_SIZE = CFG.getint('settings', 'updater_shard_size', fallback=200)
+UPDATER_LEASE_TTL = CFG.getint('settings', 'updater_lease_ttl', fallback=120)
+# How many shards can run at once; Celery's prefork pool defaults to one per CPU.
+UPDATER_SHARD_CONCURRENCY = CFG.getint('settings', 'updater_shard_concurrency', fallback=os.cpu_count() or 1)
+UPDATER_LEASE = 'updater'
 
-app = Celery('tasks', broker=BROKER_URL)
+app = Celery('tasks', broker=BROKER_URL, backend=RESULT_BACKEND)
+app.conf.task_always_eager = ALWAYS_EAGER
 
 
+@worker_process_shutdown.connect
+def close_worker_resources(**kwargs):
+    dispose_sync_engines()
+    shutdown_parse_pool()
+    dump()
+
+@app.task(bind=True)
+def run_updater(self):
+    holder = self.request.id or uuid.uuid4().hex
+    new_run_id()
+    if not acquire_lease(UPDATER_LEASE, holder, UPDATER_LEASE_TTL):
+        log_event('updater_skipped', reason='lease held')
+        return None
+
+    # The lease only covers the claim: claimed products can't be handed out
+    # twice, so a slow shard never blocks the next beat.
+    try:
+        asins = claim_due_asins()
+        chunks = [asins[start:start + UPDATER_SHARD_SIZE] for start in range(0, len(asins), UPDATER_SHARD_SIZE)]
+        if not chunks:
+            return {'checked': 0, 'shards': 0}
+
+        # Run eagerly, the shards go one after another and each gets the full rate.
+        share = 1 if app.conf.task_always_eager else min(len(chunks), UPDATER_SHARD_CONCURRENCY)
+        shards = [run_updater_shard.s(chunk, share) for chunk in chunks]
+
+        # Collecting the shard summaries needs a result backend; without one
+        # the shards are fired as a plain group.
+        if not (RESULT_BACKEND or app.conf.task_always_eager):
+            group(shards).apply_async()
+            return {'shards': len(shards)}
+
+        result = chord(shards)(collect_updater_summaries.s())
+    finally:
+        release_lease(UPDATER_LEASE, holder)
+
+    # Run eagerly, the chord has already finished by now.
+    return result.get(disable_sync_subtasks=False) if app.conf.task_always_eager else result.id
+
+@app.task
+def run_updater_shard(asins, share=1):
+    return updater(asins, share)
+
 @app.task
-def run_updater():
-    updater()
+def collect_updater_summaries(summaries):
+    summary = {**merge_summaries(summaries), 'shards': len(summaries)}
+    log_event('updater_summary', **summary)
+    return summary
 
 @app.task
 def run_clean_up():
@@ -24,7 +84,7 @@ def run_clean_up():
 app.conf.beat_schedule = {
     'run-updater-task': {
         'task': 'app.run_updater',
-        'schedule': crontab(minute='2,10,17,25,32,40,47,55')
+        'schedule': crontab(minute='*/5')
     },
     'run-clean-up-task': {
         'task': 'app.run_clean_up',
@@ -0,0 +1,72 @@
+import re
+import asyncio
+
+from urllib.parse import urljoin
+
+from scraper_client import get_client_session
+from metrics import log_event
+
+
+MAX_REDIRECTS = 3
+
+BARE_ASIN = re.compile(r'[A-Z0-9]{10}')
+AMAZON_HOST = re.compile(r'(?:https?://)?(?:[\w-]+\.)?amazon\.[a-z.]{2,6}(?::\d+)?/', re.I | re.A)
+ASIN_PATH = re.compile(r'/(?:dp|gp/product|gp/aw/d|exec/obidos/(?:ASIN|asin)|o/(?:ASIN|asin))/([A-Z0-9]{10})(?![A-Za-z0-9])')
+SHORT_LINK = re.compile(r'(?:https?://)?(?:www\.)?(?:amzn\.to|amzn\.eu|amzn\.asia|a\.co)/\S+', re.I)
+
+
+def parse_asin(text):
+    if len(text) == 10:
+        return text if BARE_ASIN.fullmatch(text) else None
+
+    # Match the host first and only search the path after it, so no slices
+    # of the argument are made on the way.
+    host = AMAZON_HOST.match(text)
+    if host is None:
+        return None
+
+    match = ASIN_PATH.search(text, host.end() - 1)
+    return match.group(1) if match else None
+
+def url_asin(url):
+    match = ASIN_PATH.search(url)
+    return match.group(1) if match else None
+
+def is_short_link(text):
+    return SHORT_LINK.fullmatch(text) is not None
+
+async def resolve_short_link(url):
+    # Short codes carry no ASIN, so the redirect target is read from the
+    # Location header without downloading any page.
+    if not url.lower().startswith(('http://', 'https://')):
+        url = 'https://' + url
+
+    session = get_client_session()
+    for _ in range(MAX_REDIRECTS):
+        try:
+            async with session.head(url, allow_redirects=False) as response:
+                location = response.headers.get('Location')
+        except Exception as e:
+            log_event('short_link_unresolved', url=url, error=str(e))
+            return None
+
+        if not location:
+            return None
+
+        url = urljoin(url, location)
+        asin = parse_asin(url)
+        if asin is not None:
+            return asin
+
+    return None
+
+async def extract_asin(text):
+    asin = parse_asin(text)
+
+    if asin is None and is_short_link(text):
+        asin = await resolve_short_link(text)
+
+    return asin
+
+async def extract_asins(args):
+    return await asyncio.gather(*(extract_asin(arg) for arg in args))
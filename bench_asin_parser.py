@@ -0,0 +1,62 @@
+import re
+import sys
+import time
+
+from asin_parser import parse_asin, url_asin
+
+
+ITERATIONS = 20000
+
+SAMPLES = [
+    'B07PGL2ZSL',
+    'https://www.amazon.com/dp/B07PGL2ZSL/',
+    'https://www.amazon.com/Echo-Dot-3rd-Gen-Charcoal/dp/B07PGL2ZSL/ref=sr_1_1?keywords=echo&qid=1&sr=8-1',
+    'amazon.com/dp/B07PGL2ZSL?th=1',
+    'https://www.amazon.co.uk/gp/product/B07PGL2ZSL/',
+    'https://smile.amazon.de/dp/B07PGL2ZSL',
+    'https://www.amazon.com/s?k=echo+dot',
+    'not an asin at all',
+]
+MESSAGE = 'Last checked: just now\n\nTitle: Echo Dot\n\nStock Status: In Stock\nPrice: $39.99\n\nBuy Now: https://www.amazon.com/dp/B07PGL2ZSL/\n\n'
+
+
+def legacy_parse(arg):
+    if re.search(r"^((https://www.amazon.com)|(http://www.amazon.com)|(https://amazon.com)|(http://amazon.com)|(www.amazon.com)|(amazon.com)).*/dp/[A-Z0-9]{10}[/?].*$", arg):
+        return re.findall(r'/dp/([A-Z0-9]{10})[/?]', arg)[0]
+
+    if re.search(r'^[A-Z0-9]{10}$', arg):
+        return arg
+
+    return None
+
+def legacy_message_asin(msg):
+    return re.findall(r'/dp/([A-Z0-9]{10})/', msg.split('Buy Now: ')[1])[0]
+
+def message_asin(msg):
+    return url_asin(msg.split('Buy Now: ')[1])
+
+def bench(func, inputs, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for value in inputs:
+            func(value)
+
+    elapsed = time.perf_counter() - started
+    return elapsed * 1e9 / (iterations * len(inputs))
+
+def main(iterations=ITERATIONS):
+    print(f"{'input':<14}{'legacy':>12}{'asin_parser':>14}")
+
+    for label, legacy, current, inputs in (
+        ('/track args', legacy_parse, parse_asin, SAMPLES),
+        ('reply text', legacy_message_asin, message_asin, [MESSAGE]),
+    ):
+        print(f"{label:<14}{bench(legacy, inputs, iterations):>9.0f} ns{bench(current, inputs, iterations):>11.0f} ns")
+
+    accepted = [sample for sample in SAMPLES if parse_asin(sample)]
+    legacy_accepted = [sample for sample in SAMPLES if legacy_parse(sample)]
+    print(f"\naccepted: legacy {len(legacy_accepted)}/{len(SAMPLES)}, asin_parser {len(accepted)}/{len(SAMPLES)}")
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import sqlite3
+import tempfile
+import statistics
+
+from sqlalchemy import create_engine
+
+import storage
+import db_utils
+from models import Base
+from db_engine import dispose_async_engines
+
+
+USERS = 10000
+PRODUCTS_PER_USER = 12
+CATALOG = 20000
+SAMPLES = 300
+
+LEGACY_ASSOCIATION_DDL = (
+    "CREATE TABLE association_table ("
+    "username VARCHAR, "
+    "product_asin VARCHAR, "
+    "FOREIGN KEY(username) REFERENCES users (username), "
+    "FOREIGN KEY(product_asin) REFERENCES products (asin))"
+)
+
+
+def asin(n):
+    return f'B{n:09d}'
+
+def build_database(path, legacy, users, products_per_user, catalog):
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(path)
+    if legacy:
+        conn.execute("DROP TABLE association_table")
+        conn.execute(LEGACY_ASSOCIATION_DDL)
+
+    conn.executemany(
+        "INSERT INTO products (title, asin, price, stock, url) VALUES (?, ?, '$1.00', 'In Stock', '')",
+        ((f'Product {n}', asin(n)) for n in range(catalog))
+    )
+    conn.executemany(
+        "INSERT INTO users (chat_id, username, stock_notification) VALUES (?, ?, 1)",
+        ((n, f'user{n}') for n in range(users))
+    )
+
+    rng = random.Random(0)
+    conn.executemany(
+        "INSERT INTO association_table (username, product_asin) VALUES (?, ?)",
+        ((f'user{n}', asin(p)) for n in range(users) for p in rng.sample(range(catalog), products_per_user))
+    )
+    conn.commit()
+    conn.close()
+
+def clear_caches():
+    # db_utils caches command-path reads; every call starts cold so the
+    # timings measure the queries and the index behind them.
+    for cache in (db_utils.USER_CACHE, db_utils.PRODUCT_CACHE, db_utils.TRACKED_CACHE, db_utils.CHAT_CACHE):
+        cache.clear()
+
+async def timed(samples, call):
+    timings = []
+    for args in samples:
+        clear_caches()
+        started = time.perf_counter()
+        await call(*args)
+        timings.append(time.perf_counter() - started)
+
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+async def run(users, catalog):
+    rng = random.Random(1)
+    pairs = [(f'user{rng.randrange(users)}', asin(rng.randrange(catalog))) for _ in range(SAMPLES)]
+    usernames = [(username,) for username, _ in pairs]
+    chat_ids = [(rng.randrange(users),) for _ in range(SAMPLES)]
+    asin_batches = [([asin(rng.randrange(catalog)) for _ in range(200)], []) for _ in range(SAMPLES // 10)]
+
+    async def toggle(username, product_asin):
+        await db_utils.create_association(username, product_asin)
+        await db_utils.remove_association_entry(username, product_asin)
+
+    results = {
+        'is_associated': await timed(pairs, db_utils.is_associated),
+        'request_limit_reached': await timed(usernames, db_utils.request_limit_reached),
+        'db_bulk_lookup': await timed(chat_ids, db_utils.db_bulk_lookup),
+        'fetch_subscribers': await timed(asin_batches, db_utils.fetch_subscribers),
+        'create+remove': await timed(pairs, toggle),
+    }
+
+    await dispose_async_engines()
+    return results
+
+def main(users=USERS, products_per_user=PRODUCTS_PER_USER, catalog=CATALOG):
+    workdir = tempfile.mkdtemp(prefix='bench_associations_')
+    print(f"{users} users x {products_per_user} products = {users * products_per_user} associations, {catalog} products")
+
+    for label, legacy in (('no key', True), ('primary key', False)):
+        path = os.path.join(workdir, f"{label.replace(' ', '_')}.sqlite3")
+        build_database(path, legacy, users, products_per_user, catalog)
+
+        # database_uri reads db_file at call time, so this points every
+        # db_utils helper at the scratch database.
+        storage.CFG['credentials']['db_file'] = path
+        clear_caches()
+
+        print(f"\n{label}")
+        for name, (median, p95) in asyncio.run(run(users, catalog)).items():
+            print(f"  {name:<22} p50 {median * 1000:8.3f} ms  p95 {p95 * 1000:8.3f} ms")
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:4]))
@@ -0,0 +1,77 @@
+import sys
+import glob
+import time
+import statistics
+import tracemalloc
+
+from extractors import BACKENDS, UnsupportedSelector, build_extractor
+
+
+FIXTURES_GLOB = 'fixtures/*.html'
+ITERATIONS = 20
+
+
+def synthetic_product_page(asin='B000000000', title='Sample Product', price='$19.99', stock='In Stock', padding_kb=400):
+    head = '<head><title>Amazon.com</title>' + '<script>var x = "' + 'a' * 20000 + '";</script>' + '<style>' + '.c{}' * 5000 + '</style></head>'
+    nav = '<div id="nav-main">' + '<a class="nav-a" href="/x">Link</a>' * 300 + '</div>'
+    buy_box = (
+        f'<div id="centerCol"><h1 id="title"><span id="productTitle"> {title} </span></h1>'
+        f'<div id="corePrice_feature_div"><span class="a-price"><span class="a-offscreen">{price}</span><span aria-hidden="true">{price}</span></span></div>'
+        f'<div id="availability"><span class="a-size-medium a-color-success"> {stock} </span></div>'
+        f'<input type="hidden" name="ASIN" value="{asin}"></div>'
+    )
+    review = '<div class="review"><p>Great product, would buy again.<br>Five stars.</p><span class="a-icon-alt">5.0 out of 5 stars</span></div>'
+    reviews = '<div id="reviews">' + review * (padding_kb * 1024 // len(review)) + '</div>'
+
+    return f'<!DOCTYPE html><html>{head}<body>{nav}{buy_box}{reviews}</body></html>'
+
+def load_pages(paths):
+    pages = []
+
+    for path in paths:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            pages.append((path, f.read()))
+
+    if not pages:
+        pages.append(('synthetic', synthetic_product_page()))
+
+    return pages
+
+def bench(extractor, html, iterations=ITERATIONS):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        extractor.extract(html)
+        timings.append(time.perf_counter() - started)
+
+    # tracemalloc only sees Python allocations, so C-level parsers (lxml)
+    # under-report here; compare their RSS separately if it matters.
+    tracemalloc.start()
+    result = extractor.extract(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return statistics.median(timings), peak, result
+
+def main(paths):
+    pages = load_pages(paths)
+    reference = build_extractor('soup')
+
+    for name, html in pages:
+        print(f"\n{name} ({len(html) // 1024} KB)")
+        expected = reference.extract(html)
+
+        for backend in BACKENDS:
+            try:
+                extractor = BACKENDS[backend](reference.selectors)
+            except UnsupportedSelector as e:
+                print(f"  {backend:<10} skipped: {e}")
+                continue
+
+            median, peak, result = bench(extractor, html)
+            status = 'ok' if result == expected else f'MISMATCH {result}'
+            print(f"  {backend:<10} {median * 1000:8.2f} ms  peak {peak / 1024:8.0f} KB  {status}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or sorted(glob.glob(FIXTURES_GLOB)))
@@ -0,0 +1,402 @@
+import os
+import sys
+import json
+import queue
+import time
+import random
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import urllib.request
+
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from aiohttp import web
+
+
+SCALES = (1000, 10000, 100000)
+TOKEN = '123456:OFFLINE-BENCH'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+SEED_CHUNK = 5000
+
+# Rate limits are lifted so the run measures the bot rather than the
+# throttles; the fake Telegram never answers 429.
+CONFIG = """[credentials]
+celery_broker_url = memory://
+token = {token}
+db_sync_uri_prefix = sqlite://
+db_async_uri_prefix = sqlite+aiosqlite://
+db_file = {db_file}
+
+[settings]
+url_prefix = http://127.0.0.1:{amazon_port}/dp/
+url_suffix = /
+telegram_base_url = http://127.0.0.1:{telegram_port}/bot
+max_requests = 50
+retry_messaging_interval = 1
+retry_scraping_interval = 1
+max_messaging_retry = 2
+max_scraping_retry = 2
+scraper_rate_per_host = 100000
+scraper_burst = 1000
+dispatch_global_rate = 100000
+dispatch_chat_rate = 1000
+dispatch_chat_burst = 1000
+metrics_dump_interval = 3600
+parse_workers = {parse_workers}
+
+[selectors]
+product_title = #productTitle
+product_price = #corePrice_feature_div span.a-offscreen
+product_stock = #availability
+"""
+
+
+def asin(n):
+    return f'B{n:09d}'
+
+def initial_cents(product_asin):
+    return 1000 + int(product_asin[1:]) * 37 % 9000
+
+def price_text(cents):
+    return f'${cents // 100:,}.{cents % 100:02d}'
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def fetch_json(url):
+    with urllib.request.urlopen(url) as response:
+        return json.loads(response.read())
+
+
+class FakeAmazon:
+    def __init__(self, latency, error_rate, churn, padding_kb):
+        from bench_extractors import synthetic_product_page
+
+        self.template = synthetic_product_page(asin='@ASIN@', title='@TITLE@', price='@PRICE@', padding_kb=padding_kb)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.churn = churn
+        self.prices = {}
+        self.rng = random.Random(3)
+        self.stats = {'requests': 0, 'errors': 0, 'churned': 0}
+
+    async def product_page(self, request):
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.rng.expovariate(1 / self.latency))
+
+        if self.rng.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return web.Response(status=503, text='Service Unavailable')
+
+        product_asin = request.match_info['asin']
+        cents = self.prices.get(product_asin) or initial_cents(product_asin)
+        if self.rng.random() < self.churn:
+            cents = max(100, cents + self.rng.choice((-1, 1)) * self.rng.randrange(1, 500))
+            self.stats['churned'] += 1
+        self.prices[product_asin] = cents
+
+        page = self.template.replace('@ASIN@', product_asin).replace('@TITLE@', f'Product {product_asin}').replace('@PRICE@', price_text(cents))
+        return web.Response(text=page, content_type='text/html')
+
+
+class FakeTelegram:
+    def __init__(self, latency):
+        self.latency = latency
+        self.rng = random.Random(4)
+        self.stats = {'requests': 0, 'messages': 0}
+
+    async def bot_api(self, request):
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.rng.expovariate(1 / self.latency))
+
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = await request.post()
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'sendMessage':
+            self.stats['messages'] += 1
+            result = {'message_id': self.stats['messages'], 'date': int(time.time()), 'chat': {'id': int(params['chat_id']), 'type': 'private'}, 'text': params['text']}
+        else:
+            result = True
+
+        return web.json_response({'ok': True, 'result': result})
+
+
+async def serve_fakes(options, amazon_port, telegram_port):
+    amazon = FakeAmazon(options.amazon_latency, options.error_rate, options.churn, options.padding_kb)
+    telegram = FakeTelegram(options.telegram_latency)
+
+    async def stats(request):
+        return web.json_response({'amazon': amazon.stats, 'telegram': telegram.stats})
+
+    runners = []
+    for port, routes in ((amazon_port, [web.get('/dp/{asin}/', amazon.product_page)]), (telegram_port, [web.post('/bot{token}/{method}', telegram.bot_api)])):
+        app = web.Application()
+        app.add_routes([*routes, web.get('/stats', stats)])
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        runners.append(runner)
+
+    await asyncio.Event().wait()
+
+def run_fakes(options, amazon_port, telegram_port):
+    asyncio.run(serve_fakes(options, amazon_port, telegram_port))
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def wait_for_report(worker, results, size):
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not worker.is_alive():
+                raise RuntimeError(f"Benchmark of {size} products failed, see bench_{size}.log")
+
+def seed(size, tracked):
+    from sqlalchemy import insert
+
+    import storage
+    from models import Base, User, Product, association_table
+    from db_engine import get_engine, dispose_sync_engines
+    from utils import construct_url
+
+    engine = get_engine(storage.database_uri(_sync=True), _sync=True)
+    Base.metadata.create_all(engine)
+    rng = random.Random(0)
+    due = datetime.now() - timedelta(minutes=1)
+
+    # Every product is watched by its own user plus a few random ones, and
+    # every product is due, so the first updater run checks the whole catalog.
+    for start in range(0, size, SEED_CHUNK):
+        numbers = range(start, min(size, start + SEED_CHUNK))
+        with engine.begin() as conn:
+            conn.execute(insert(User.__table__), [{'chat_id': n, 'username': f'user{n}', 'stock_notification': True} for n in numbers])
+            conn.execute(insert(Product.__table__), [
+                {
+                    'title': f'Product {asin(n)}', 'asin': asin(n), 'price': price_text(initial_cents(asin(n))), 'price_cents': initial_cents(asin(n)),
+                    'currency': 'USD', 'price_change_bp': 0, 'stock': 'In Stock', 'url': construct_url(asin(n)),
+                    'last_checked': due, 'last_updated': due, 'next_check': due, 'change_score': 0
+                }
+                for n in numbers
+            ])
+            conn.execute(insert(association_table), [
+                {'username': f'user{n}', 'product_asin': asin(p)}
+                for n in numbers for p in {n, *rng.sample(range(size), tracked - 1)}
+            ])
+
+    dispose_sync_engines()
+
+async def run_commands(size, options, telegram_stats_url):
+    from core_funcs import register, bulk_update
+    from dispatcher import drain_dispatcher, close_dispatcher
+    from utils import construct_url, close_bot
+    from scraper_client import close_client_session
+    from db_engine import dispose_async_engines
+
+    rng = random.Random(5)
+    numbers = rng.sample(range(size), min(size, options.commands))
+    registers, bulk_updates = [], []
+
+    # Handlers run one update at a time, as PTB dispatches them by default.
+    try:
+        sent = fetch_json(telegram_stats_url)['telegram']['messages']
+        started = time.perf_counter()
+
+        for n in numbers:
+            user_info = SimpleNamespace(id=n, username=f'user{n}', first_name='Bench', last_name=None)
+            args = [asin(rng.randrange(size)), asin(rng.randrange(size)), construct_url(asin(size + n))]
+
+            call_started = time.perf_counter()
+            await register(n, user_info, args)
+            registers.append(time.perf_counter() - call_started)
+
+        for n in numbers:
+            call_started = time.perf_counter()
+            await bulk_update(n)
+            bulk_updates.append(time.perf_counter() - call_started)
+
+        await drain_dispatcher()
+        elapsed = time.perf_counter() - started
+        sent = fetch_json(telegram_stats_url)['telegram']['messages'] - sent
+    finally:
+        await close_dispatcher()
+        await close_bot()
+        await close_client_session()
+        await dispose_async_engines()
+
+    return {'commands': len(registers) + len(bulk_updates), 'elapsed': elapsed, 'messages': sent, 'register': registers, 'bulk_update': bulk_updates}
+
+def orphan_users(size, fraction):
+    from sqlalchemy import select, func
+
+    from models import Product, association_table
+    from db_utils import make_session, orphan_products_stmt
+
+    rng = random.Random(6)
+    usernames = [f'user{n}' for n in rng.sample(range(size), int(size * fraction))]
+
+    # The same statements /stopall runs, issued in bulk so setting up the
+    # clean-up doesn't dominate the run.
+    sync_session = make_session(_sync=True)
+    with sync_session() as session:
+        for start in range(0, len(usernames), 500):
+            chunk = usernames[start:start + 500]
+            asins = session.execute(select(association_table.c.product_asin).where(association_table.c.username.in_(chunk))).scalars().all()
+            session.execute(association_table.delete().where(association_table.c.username.in_(chunk)))
+            if asins:
+                session.execute(orphan_products_stmt(set(asins)))
+
+        session.commit()
+        return session.execute(select(func.count()).select_from(Product).where(Product.orphaned_since.isnot(None))).scalar()
+
+def count_products():
+    from sqlalchemy import select, func
+
+    from models import Product
+    from db_utils import make_session
+
+    sync_session = make_session(_sync=True)
+    with sync_session() as session:
+        return session.execute(select(func.count()).select_from(Product)).scalar()
+
+def run_scale(size, options, telegram_port, results):
+    # Everything the bot prints goes to a log beside the database.
+    sys.stdout = open(f'bench_{size}.log', 'w', buffering=1)
+
+    from scheduler import percentile
+    from periodic_tasks import run_update_cycle, clean_up
+    from parse_pool import shutdown_parse_pool
+    from db_engine import dispose_sync_engines
+
+    telegram_stats_url = f'http://127.0.0.1:{telegram_port}/stats'
+    report = {'size': size}
+
+    started = time.perf_counter()
+    seed(size, options.tracked)
+    report['seed'] = time.perf_counter() - started
+
+    sent = fetch_json(telegram_stats_url)['telegram']['messages']
+    started = time.perf_counter()
+    summary = asyncio.run(run_update_cycle())
+    elapsed = time.perf_counter() - started
+    report['updater'] = {
+        'elapsed': elapsed, 'checked': summary['checked'], 'changed': summary['changed'], 'failed': summary['failed'],
+        'messages': fetch_json(telegram_stats_url)['telegram']['messages'] - sent,
+        'p95': summary['p95_latency'], 'p95_send': summary['notifications']['p95_send_latency']
+    }
+
+    commands = asyncio.run(run_commands(size, options, telegram_stats_url))
+    report['commands'] = {
+        'elapsed': commands['elapsed'], 'commands': commands['commands'], 'messages': commands['messages'],
+        'p95_register': percentile(commands['register'], 95), 'p95_bulk_update': percentile(commands['bulk_update'], 95)
+    }
+
+    candidates = orphan_users(size, options.unsubscribe)
+    before = count_products()
+    started = time.perf_counter()
+    clean_up()
+    report['clean_up'] = {'elapsed': time.perf_counter() - started, 'candidates': candidates, 'deleted': before - count_products()}
+
+    shutdown_parse_pool()
+    dispose_sync_engines()
+
+    # ru_maxrss is in KiB on Linux; parse workers count once they've exited.
+    report['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    report['rss_children'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    results.put(report)
+
+def print_report(report):
+    updater = report['updater']
+    commands = report['commands']
+    cleaned = report['clean_up']
+
+    print(f"\n{report['size']} products / {report['size']} users (seeded in {report['seed']:.1f}s)")
+    print(
+        f"  updater   {updater['checked']:7d} checked  {updater['checked'] / updater['elapsed']:8.0f} products/s  {updater['messages'] / updater['elapsed']:7.0f} msgs/s"
+        f"  p95 check {updater['p95'] * 1000:7.1f} ms  p95 send {updater['p95_send'] * 1000:7.1f} ms  changed {updater['changed']}  failed {updater['failed']}"
+    )
+    print(
+        f"  commands  {commands['commands']:7d} handled  {commands['commands'] / commands['elapsed']:8.0f} commands/s  {commands['messages'] / commands['elapsed']:7.0f} msgs/s"
+        f"  p95 /track {commands['p95_register'] * 1000:7.1f} ms  p95 /updateall {commands['p95_bulk_update'] * 1000:7.1f} ms"
+    )
+    print(f"  clean_up  {cleaned['deleted']:7d} deleted  {cleaned['deleted'] / cleaned['elapsed']:8.0f} products/s  of {cleaned['candidates']} candidates in {cleaned['elapsed']:.2f}s")
+    print(f"  peak RSS  {report['rss']:7.0f} MB  (parse workers {report['rss_children']:.0f} MB)")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Drive the updater, commands and clean-up against local stand-ins for Amazon and Telegram.')
+    parser.add_argument('sizes', nargs='*', type=int, default=SCALES, help='catalog sizes; each gets as many users')
+    parser.add_argument('--amazon-latency', type=float, default=0.02, help='mean page latency in seconds')
+    parser.add_argument('--telegram-latency', type=float, default=0.01, help='mean Bot API latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='share of page requests answered with a 503')
+    parser.add_argument('--churn', type=float, default=0.1, help='share of page requests that see a new price')
+    parser.add_argument('--padding-kb', type=int, default=100, help='size of the filler around the buy box')
+    parser.add_argument('--parse-workers', type=int, default=0, help='parse pool size; 0 parses inline like the default config')
+    parser.add_argument('--tracked', type=int, default=3, help='products tracked per user')
+    parser.add_argument('--commands', type=int, default=200, help='users sending /track and /updateall')
+    parser.add_argument('--unsubscribe', type=float, default=0.3, help='share of users that stop tracking before clean-up')
+    return parser.parse_args(argv)
+
+def main(argv):
+    options = parse_args(argv)
+    context = multiprocessing.get_context('spawn')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    # Modules read config.ini from the working directory at import time, so
+    # every process runs inside a scratch directory with its own config.
+    workdir = tempfile.mkdtemp(prefix='bench_offline_')
+    os.chdir(workdir)
+    amazon_port, telegram_port = free_port(), free_port()
+
+    # The stand-ins share the machine with the bot, so compare runs made on
+    # the same host only.
+    print(f"{os.cpu_count()} CPUs; Amazon stand-in: {options.amazon_latency * 1000:.0f} ms, {options.error_rate:.0%} errors, {options.churn:.0%} churn, {options.padding_kb} KB pages")
+    print(f"Telegram stand-in: {options.telegram_latency * 1000:.0f} ms; throttles lifted; {options.parse_workers or 'no'} parse workers; logs and metrics in {workdir}")
+
+    fakes = None
+    try:
+        for size in options.sizes:
+            with open('config.ini', 'w') as f:
+                f.write(CONFIG.format(token=TOKEN, db_file=f'bench_{size}.sqlite3', amazon_port=amazon_port, telegram_port=telegram_port, parse_workers=options.parse_workers))
+
+            if fakes is None:
+                fakes = context.Process(target=run_fakes, args=(options, amazon_port, telegram_port), daemon=True)
+                fakes.start()
+                wait_for_port(amazon_port)
+                wait_for_port(telegram_port)
+
+            results = context.Queue()
+            worker = context.Process(target=run_scale, args=(size, options, telegram_port, results))
+            worker.start()
+            report = wait_for_report(worker, results, size)
+            worker.join()
+
+            print_report(report)
+    finally:
+        if fakes is not None:
+            fakes.terminate()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
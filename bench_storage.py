@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import tempfile
+import multiprocessing
+
+from datetime import datetime
+from sqlalchemy import update, bindparam
+
+import storage
+import db_utils
+from models import Product, PriceHistory
+from db_engine import get_engine, dispose_async_engines, dispose_sync_engines
+from scheduler import percentile
+from bench_associations import build_database, asin
+
+
+USERS = 2000
+PRODUCTS_PER_USER = 10
+CATALOG = 20000
+DURATION = 10
+READERS = 4
+WRITE_BATCH = 200
+
+PROFILES = {
+    # No pragmas: what every connection got before the storage layer.
+    'sqlite defaults': {},
+    'tuned': dict(storage.SQLITE_PRAGMAS),
+}
+
+
+def use_profile(path, pragmas):
+    storage.SQLITE_PRAGMAS = pragmas
+    storage.CFG['credentials']['db_file'] = path
+
+def write_load(path, pragmas, catalog, duration, results):
+    # Stands in for an updater run: batched product updates plus history
+    # appends, committed once per batch like WriteBatcher does.
+    use_profile(path, pragmas)
+    engine = get_engine(storage.database_uri(_sync=True), _sync=True)
+    stmt = update(Product.__table__).where(Product.__table__.c.id == bindparam('_id')).values(price_cents=bindparam('price_cents'), last_checked=bindparam('last_checked'))
+    rng = random.Random(2)
+    stats = {'batches': 0, 'rows': 0, 'errors': 0}
+    tick = int(time.time()) * 1000
+
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        ids = rng.sample(range(1, catalog + 1), WRITE_BATCH)
+        now = datetime.now()
+        tick += 1
+
+        try:
+            with engine.begin() as conn:
+                conn.execute(stmt, [{'_id': product_id, 'price_cents': rng.randrange(100, 10000), 'last_checked': now} for product_id in ids])
+                conn.execute(storage.insert_ignore(PriceHistory.__table__), [{'product_id': product_id, 'recorded_at': tick, 'price_cents': 100, 'stock': 1} for product_id in ids])
+            stats['batches'] += 1
+            stats['rows'] += len(ids)
+        except Exception:
+            stats['errors'] += 1
+
+    dispose_sync_engines()
+    results.put(stats)
+
+async def read_load(users, catalog, duration):
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def reader(seed):
+        nonlocal errors
+        rng = random.Random(seed)
+
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                await db_utils.tracked_count(f'user{rng.randrange(users)}')
+                await db_utils.fetch_products([asin(rng.randrange(catalog)) for _ in range(5)])
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(reader(seed) for seed in range(READERS)))
+    await dispose_async_engines()
+
+    return {'reads': len(latencies), 'errors': errors, 'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'max': max(latencies, default=0)}
+
+def main(users=USERS, products_per_user=PRODUCTS_PER_USER, catalog=CATALOG, duration=DURATION):
+    workdir = tempfile.mkdtemp(prefix='bench_storage_')
+    context = multiprocessing.get_context('spawn')
+    print(f"{catalog} products, {users} users, {READERS} readers vs 1 writer for {duration}s")
+
+    for label, pragmas in PROFILES.items():
+        path = os.path.join(workdir, f"{label.replace(' ', '_')}.sqlite3")
+        build_database(path, False, users, products_per_user, catalog)
+        use_profile(path, pragmas)
+
+        results = context.Queue()
+        writer = context.Process(target=write_load, args=(path, pragmas, catalog, duration, results))
+        writer.start()
+        reads = asyncio.run(read_load(users, catalog, duration))
+        writes = results.get()
+        writer.join()
+
+        print(f"\n{label}")
+        print(f"  reads   {reads['reads'] / duration:8.0f}/s  p50 {reads['p50'] * 1000:7.2f} ms  p95 {reads['p95'] * 1000:7.2f} ms  max {reads['max'] * 1000:8.2f} ms  errors {reads['errors']}")
+        print(f"  writes  {writes['rows'] / duration:8.0f} rows/s  batches {writes['batches']}  errors {writes['errors']}")
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:5]))
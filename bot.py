@@ -1,11 +1,15 @@
 import configparser
 
 from telegram import Update
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler
+from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler
 
-from core_funcs import register, stop_updates, stop_all_updates, restart_updates, process_update, bulk_update
-from utils import start_response, about_response, help_response
+from core_funcs import register, stop_updates, stop_all_updates, restart_updates, process_update, bulk_update, handle_button
+from utils import start_response, about_response, help_response, close_bot
 from db_utils import fetch_or_create_user
+from db_engine import dispose_async_engines, dispose_sync_engines
+from scraper_client import close_client_session
+from dispatcher import close_dispatcher
+from metrics import dump
 
 
 CFG = configparser.ConfigParser()
@@ -13,6 +17,7 @@ CFG.read('config.ini')
 URL_PREFIX = CFG['settings']['url_prefix']
 URL_SUFFIX = CFG['settings']['url_suffix']
 TOKEN = CFG['credentials']['token']
+TELEGRAM_BASE_URL = CFG.get('settings', 'telegram_base_url', fallback='https://api.telegram.org/bot')
 
 START_TEXT = start_response()
 ABOUT_TEXT = about_response()
@@ -38,7 +43,8 @@ async def track(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def update(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_message = update.effective_message.reply_to_message
-    this_bot = await context.bot.get_me()
+    # Identity cached by get_me() when the application initialised.
+    this_bot = context.bot.bot
 
     response = await process_update(this_bot, update.effective_chat.id, update.effective_user.username, reply_message)
     if response:
@@ -51,9 +57,9 @@ async def updateall(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_message = update.effective_message.reply_to_message
-    this_bot = await context.bot.get_me()
+    this_bot = context.bot.bot
 
-    response = await stop_updates(this_bot, update.effective_user.username, reply_message)
+    response = await stop_updates(this_bot, update.effective_chat.id, update.effective_user.username, reply_message)
     if response:
         await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
 
@@ -64,14 +70,30 @@ async def stopall(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_message = update.effective_message.reply_to_message
-    this_bot = await context.bot.get_me()
-    
+    this_bot = context.bot.bot
+
     response = await restart_updates(this_bot, update.effective_chat.id, update.effective_user.username, reply_message)
     if response:
         await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
 
+async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    response = await handle_button(update.effective_chat.id, update.effective_user.username, query.data)
+    if response:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
+
+async def shutdown(application):
+    await close_dispatcher()
+    await close_bot()
+    await close_client_session()
+    await dispose_async_engines()
+    dispose_sync_engines()
+    dump()
+
 if __name__ == "__main__":
-    app = ApplicationBuilder().token(TOKEN).build()
+    app = ApplicationBuilder().token(TOKEN).base_url(TELEGRAM_BASE_URL).post_shutdown(shutdown).build()
 
     start_handler = CommandHandler('start', start)
     app.add_handler(start_handler)
@@ -91,5 +113,7 @@ if __name__ == "__main__":
     app.add_handler(stopall_handler)
     restart_handler = CommandHandler('restart', restart)
     app.add_handler(restart_handler)
+    button_handler = CallbackQueryHandler(button)
+    app.add_handler(button_handler)
 
     app.run_polling()
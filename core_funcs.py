@@ -1,57 +1,79 @@
-import re
 import configparser
 
-from utils import get_data, construct_message, extract_data_from_message, send, send_message
-from db_utils import is_valid_request, save_to_database, request_limit_reached, db_lookup, db_bulk_lookup, fetch_product, remove_association_entry, reassign_product
+from utils import get_data, construct_url, construct_message, extract_data_from_message, product_keyboard, keyboard_asins, restart_keyboard, send, send_message
+from messages import combine_messages
+from asin_parser import parse_asin, extract_asins
+from scheduler import run_bounded
+from dispatcher import dispatch, dispatch_message
+from metrics import inc, log_event
+from db_utils import fetch_or_create_user, tracked_asins, fetch_products, register_products, db_lookup, db_bulk_lookup, remove_association_entry, reassign_product
 
 
 CFG = configparser.ConfigParser()
 CFG.read('config.ini')
-MAX_REQUESTS = CFG['settings']['max_requests']
+MAX_REQUESTS = int(CFG['settings']['max_requests'])
+TRACK_CONCURRENCY = CFG.getint('settings', 'track_concurrency', fallback=5)
+SCRAPER_RATE_PER_HOST = CFG.getfloat('settings', 'scraper_rate_per_host', fallback=5)
+SCRAPER_BURST = CFG.getint('settings', 'scraper_burst', fallback=10)
+REPLY_PREFIXES = ('Update Alert!', 'Title: ', 'Last checked: ', 'Tracking Restarted!')
+STOP_PREFIX = 'Product ('
+COMBINED_REPLY = "That message lists several products. Please press the button under the product you mean instead."
 
 
-async def scrape_handler(asin, user_info):
-    raw_data = await get_data(asin=asin)
+async def scrape_missing(asins):
+    scraped = {}
 
-    if raw_data['title'] is None or raw_data['price'] is None:
-        return f"Unexpected error occured, couldn't retrieve product information. Please try again.\n\n"
+    async def scrape(asin):
+        data = await get_data(asin=asin)
+        if data is not None and data['title'] is not None and data['price'] is not None:
+            scraped[asin] = data
 
-    processed_data = await save_to_database(raw_data, user_info)
-    return construct_message(processed_data)
+    await run_bounded(asins, scrape, TRACK_CONCURRENCY, SCRAPER_RATE_PER_HOST, SCRAPER_BURST, get_url=construct_url)
+    return scraped
 
-async def pre_scrape_checker(asin, user_info):
-    if await is_valid_request(user_info.username, asin):
-        product = await fetch_product(asin)
-        
-        if product:
-            await save_to_database(product, user_info, obj=True)
-            return construct_message(product)
-        
-        return await scrape_handler(asin, user_info)
+async def register(chat_id, user_info, args):
+    username = user_info.username
+    replies = {}
+    order = []
+    requested = []
 
-    return f"You already have this product (Asin: {asin}) registered.\n\n"
+    for arg, asin in zip(args, await extract_asins(args)):
+        order.append(asin or arg)
 
-async def argumnent_validator(arg, user_info):
-    if re.search(r"^((https://www.amazon.com)|(http://www.amazon.com)|(https://amazon.com)|(http://amazon.com)|(www.amazon.com)|(amazon.com)).*/dp/[A-Z0-9]{10}[/?].*$", arg):
-        if await request_limit_reached(user_info.username):
-            return f"Sorry, maximum tracking request limit({MAX_REQUESTS}) reached.\n\n"
+        if asin is None:
+            replies[arg] = f"Invalid product URL (or) Asin ({arg}). Please try again with valid parameters.\n\n"
+        elif asin not in requested:
+            requested.append(asin)
 
-        asin = re.findall(r'/dp/([A-Z0-9]{10})[/?]', arg)[0]
-        return await pre_scrape_checker(asin, user_info)    
-    
-    if re.search(r'^[A-Z0-9]{10}$', arg):
-        if await request_limit_reached(user_info.username):
-            return f"Sorry, maximum tracking request limit({MAX_REQUESTS}) reached.\n\n"
+    await fetch_or_create_user(user_info)
+    tracked = set(await tracked_asins(username))
+    remaining = MAX_REQUESTS - len(tracked)
+    accepted = []
 
-        asin = arg
-        return await pre_scrape_checker(asin, user_info)
+    for asin in requested:
+        if asin in tracked:
+            replies[asin] = f"You already have this product (Asin: {asin}) registered.\n\n"
+        elif len(accepted) >= remaining:
+            replies[asin] = f"Sorry, maximum tracking request limit({MAX_REQUESTS}) reached.\n\n"
+        else:
+            accepted.append(asin)
 
-    return "Invalid product URL (or) Asin. Please try again with valid parameters."
+    existing = await fetch_products(accepted)
+    scraped = await scrape_missing([asin for asin in accepted if asin not in existing])
 
-async def register(chat_id, user_info, args):
-    for arg in args:
-        msg = await argumnent_validator(arg, user_info)
-        await send(chat_id, msg)
+    to_register = [asin for asin in accepted if asin in existing or asin in scraped]
+    products = await register_products(username, list(scraped.values()), to_register) if to_register else {}
+
+    for asin in accepted:
+        if asin in products:
+            replies[asin] = construct_message(products[asin])
+        else:
+            replies[asin] = f"Unexpected error occured, couldn't retrieve product information (Asin: {asin}). Please try again.\n\n"
+
+    parts = [(replies.pop(key), key if key in products else None) for key in order if key in replies]
+
+    for text, asins in combine_messages(parts):
+        await dispatch(chat_id, text, reply_markup=product_keyboard(*asins) if asins else None)
 
 async def single_update(chat_id, username, asin):
     product = await db_lookup(username, asin)
@@ -69,30 +91,61 @@ async def bulk_update(chat_id):
         return "You don't have any product registered for tracking."
 
     for product in products:
-        await send_message(chat_id, product)
+        await dispatch_message(chat_id, product)
 
     return None
 
+def reply_asin(this_bot, msg, prefixes=REPLY_PREFIXES):
+    if not msg or msg.from_user != this_bot:
+        return None
+
+    if msg.reply_markup:
+        asins = keyboard_asins(msg.reply_markup)
+        if len(asins) == 1:
+            return asins[0]
+        # A combined /track reply names several products, and its text
+        # would only point at the first of them.
+        if asins:
+            return None
+
+    # Messages sent before the keyboards existed only carry the ASIN in their text.
+    if msg.text and msg.text.startswith(prefixes):
+        return extract_data_from_message(msg.text, stop_msg=msg.text.startswith(STOP_PREFIX))['asin']
+
+    return None
+
+def combined_reply(this_bot, msg):
+    return bool(msg and msg.from_user == this_bot and msg.reply_markup and len(keyboard_asins(msg.reply_markup)) > 1)
+
 async def process_update(this_bot, chat_id, username, msg=None):
     if msg:
-        if msg.from_user == this_bot and msg.text.startswith(('Update Alert!', 'Title: ', 'Last checked: ', 'Tracking Restarted!')):
-            data = extract_data_from_message(msg.text)
-            return await single_update(chat_id, username, data['asin'])
+        asin = reply_asin(this_bot, msg)
+        if asin:
+            return await single_update(chat_id, username, asin)
+        if combined_reply(this_bot, msg):
+            return COMBINED_REPLY
 
         return "Invalid update request..."
     
     return f"Please reply to any of the product related messages from the bot of the product you want to get update of."
 
-async def stop_updates(this_bot, username, msg):
-    if msg and msg.from_user == this_bot and msg.text.startswith(('Update Alert!', 'Title: ', 'Last checked: ', 'Tracking Restarted!')):
-        data = extract_data_from_message(msg.text)
-        try:
-            await remove_association_entry(username, asin=data['asin'])
+async def stop_product(chat_id, username, asin):
+    try:
+        await remove_association_entry(username, asin=asin)
+
+        await send(chat_id, f"Product ({ construct_url(asin) }) has been removed from your tracking list. To start recieiving updates again, reply with /restart", reply_markup=restart_keyboard(asin))
+        return None
+    except Exception as e:
+        inc('handler_errors', handler='stop_product')
+        log_event('handler_failed', handler='stop_product', username=username, error=str(e))
+        return "An unexpected error occured, please try again."
 
-            return f"Product ({ data['url'] }) has been removed from your tracking list. To start recieiving updates again, reply with /restart"
-        except Exception as e:
-            print(e)
-            return "An unexpected error occured, please try again."
+async def stop_updates(this_bot, chat_id, username, msg):
+    asin = reply_asin(this_bot, msg)
+    if asin:
+        return await stop_product(chat_id, username, asin)
+    if combined_reply(this_bot, msg):
+        return COMBINED_REPLY
 
     return "Please reply to any of the product related messages from the bot of the product you don't want to recieve updates of anymore."
 
@@ -102,25 +155,42 @@ async def stop_all_updates(username):
 
         return f"Tracking stopped. You won't receive any more updates."
     except Exception as e:
-        print(e)
+        inc('handler_errors', handler='stop_all_updates')
+        log_event('handler_failed', handler='stop_all_updates', username=username, error=str(e))
         return f"An unexpected error occured, please try again."
 
+async def restart_product(chat_id, username, asin):
+    try:
+        product = await reassign_product(username, asin=asin)
+        if product:
+            await send_message(chat_id, product, restart_updates=True)
+            return None
+
+        return "You already have this product registered."
+    except Exception as e:
+        inc('handler_errors', handler='restart_product')
+        log_event('handler_failed', handler='restart_product', username=username, error=str(e))
+        return "An unexpected error occured, please try again."
+
 async def restart_updates(this_bot, chat_id, username, msg):
-    if msg and msg.from_user == this_bot and msg.text.startswith(('Update Alert!', 'Title: ', 'Last checked: ', 'Tracking Restarted!', 'Product (')):
-        stop_msg = False
-        if msg.text.startswith('Product ('):
-            stop_msg = True
-        data = extract_data_from_message(msg.text, stop_msg=stop_msg)
-
-        try:
-            product = await reassign_product(username, asin=data['asin'])
-            if product:
-                await send_message(chat_id, product, restart_updates=True)
-                return None
-
-            return "You already have this product registered."
-        except Exception as e:
-            print(e)
-            return "An unexpected error occured, please try again."
- 
+    asin = reply_asin(this_bot, msg, prefixes=(*REPLY_PREFIXES, STOP_PREFIX))
+    if asin:
+        return await restart_product(chat_id, username, asin)
+    if combined_reply(this_bot, msg):
+        return COMBINED_REPLY
+
     return "Please reply to any of the product related messages from the bot of the previously updating stopped product you want to start recieving updates of again."
+
+async def handle_button(chat_id, username, data):
+    action, _, asin = data.partition(':')
+    if parse_asin(asin) != asin:
+        return "Invalid update request..."
+
+    if action == 'u':
+        return await single_update(chat_id, username, asin)
+    if action == 's':
+        return await stop_product(chat_id, username, asin)
+    if action == 'r':
+        return await restart_product(chat_id, username, asin)
+
+    return "Invalid update request..."
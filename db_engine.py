@@ -0,0 +1,117 @@
+import threading
+import configparser
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+from storage import is_sqlite, configure_engine
+from metrics import register_collector
+
+
+CFG = configparser.ConfigParser()
+CFG.read('config.ini')
+DB_POOL_SIZE = CFG.getint('settings', 'db_pool_size', fallback=5)
+DB_MAX_OVERFLOW = CFG.getint('settings', 'db_max_overflow', fallback=10)
+DB_POOL_TIMEOUT = CFG.getint('settings', 'db_pool_timeout', fallback=30)
+
+# (db_uri, _sync) -> (engine, session factory)
+_REGISTRY = {}
+# (db_uri, _sync) -> counters, kept across dispose() so churn stays visible
+_STATS = {}
+_LOCK = threading.Lock()
+
+
+def _attach_counters(engine, key):
+    stats = _STATS.setdefault(key, {'connects': 0, 'checkouts': 0, 'engines_created': 0})
+    stats['engines_created'] += 1
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        stats['connects'] += 1
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats['checkouts'] += 1
+
+def _build(db_uri, _sync):
+    pool_options = {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT
+    }
+
+    if _sync:
+        connect_args = {'check_same_thread': False} if is_sqlite(db_uri) else {}
+        engine = create_engine(db_uri, poolclass=QueuePool, connect_args=connect_args, **pool_options)
+        configure_engine(engine, db_uri)
+        _attach_counters(engine, (db_uri, _sync))
+        return engine, sessionmaker(bind=engine, expire_on_commit=False)
+
+    engine = create_async_engine(db_uri, poolclass=AsyncAdaptedQueuePool, **pool_options)
+    configure_engine(engine.sync_engine, db_uri)
+    _attach_counters(engine.sync_engine, (db_uri, _sync))
+    return engine, sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+def _entry(db_uri, _sync):
+    key = (db_uri, _sync)
+    entry = _REGISTRY.get(key)
+
+    if entry is None:
+        with _LOCK:
+            entry = _REGISTRY.get(key)
+            if entry is None:
+                entry = _build(db_uri, _sync)
+                _REGISTRY[key] = entry
+
+    return entry
+
+def get_engine(db_uri, _sync=False):
+    return _entry(db_uri, _sync)[0]
+
+def get_session_factory(db_uri, _sync=False):
+    return _entry(db_uri, _sync)[1]
+
+async def dispose_async_engines():
+    # Async pools are bound to the event loop that opened them, so every
+    # asyncio.run() that used them has to dispose them before it returns.
+    with _LOCK:
+        keys = [key for key in _REGISTRY if not key[1]]
+        entries = [_REGISTRY.pop(key) for key in keys]
+
+    for engine, _ in entries:
+        await engine.dispose()
+
+def dispose_sync_engines():
+    with _LOCK:
+        keys = [key for key in _REGISTRY if key[1]]
+        entries = [_REGISTRY.pop(key) for key in keys]
+
+    for engine, _ in entries:
+        engine.dispose()
+
+def engine_stats():
+    stats = []
+
+    for (db_uri, _sync), counters in _STATS.items():
+        entry = _REGISTRY.get((db_uri, _sync))
+        pool = (entry[0] if _sync else entry[0].sync_engine).pool if entry else None
+
+        stats.append({
+            'uri': repr(make_url(db_uri)),
+            'sync': _sync,
+            'active': entry is not None,
+            'pool_size': pool.size() if pool else 0,
+            'checked_out': pool.checkedout() if pool else 0,
+            'overflow': pool.overflow() if pool else 0,
+            'engines_created': counters['engines_created'],
+            'connects': counters['connects'],
+            'checkouts': counters['checkouts'],
+            'reused': counters['checkouts'] - counters['connects']
+        })
+
+    return stats
+
+register_collector('db_engine', engine_stats)
@@ -1,60 +1,107 @@
 import configparser
 
-from sqlalchemy import insert, create_engine
-from sqlalchemy.orm import sessionmaker, selectinload
+from datetime import datetime
+from cachetools import TTLCache
+from sqlalchemy import func, update, exists, or_, and_
+from sqlalchemy.orm import selectinload
 from sqlalchemy.future import select
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
 from models import User, Product, association_table
-from utils import get_data
+from utils import get_data, set_price
+from db_engine import get_session_factory
+from storage import database_uri, insert_ignore
+from metrics import timed, register_collector
 
 
 CFG = configparser.ConfigParser()
 CFG.read('config.ini')
 MAX_REQUESTS = int(CFG['settings']['max_requests'])
+# IN lists are split to stay well under SQLite's bound-parameter limit.
+BIND_PARAM_CHUNK = 400
+DB_CACHE_SIZE = CFG.getint('settings', 'db_cache_size', fallback=10000)
+DB_CACHE_TTL = CFG.getfloat('settings', 'db_cache_ttl', fallback=60)
 
+# Read-through caches for the command handlers. Entries are dropped on local
+# writes; writes from other processes (the updater) show up once the TTL runs out.
+USER_CACHE = TTLCache(maxsize=DB_CACHE_SIZE, ttl=DB_CACHE_TTL)
+PRODUCT_CACHE = TTLCache(maxsize=DB_CACHE_SIZE, ttl=DB_CACHE_TTL)
+TRACKED_CACHE = TTLCache(maxsize=DB_CACHE_SIZE, ttl=DB_CACHE_TTL)
+CHAT_CACHE = TTLCache(maxsize=DB_CACHE_SIZE, ttl=DB_CACHE_TTL)
+CACHE_STATS = {'hits': 0, 'misses': 0, 'invalidations': 0}
+NEW_PRODUCT_COLUMNS = ('title', 'asin', 'price', 'price_cents', 'currency', 'previous_price_cents', 'price_change_bp', 'stock', 'url')
 
-def construct_db_uri(_sync=False):
-    if _sync:
-        return f"{CFG['credentials']['db_sync_uri_prefix']}/{CFG['credentials']['db_file']}"
 
-    return f"{CFG['credentials']['db_async_uri_prefix']}/{CFG['credentials']['db_file']}"
+def construct_db_uri(_sync=False):
+    return database_uri(_sync=_sync)
 
 def make_session(_sync=False):
-    if _sync:
-        db_uri = construct_db_uri(_sync=True)
-        Engine = create_engine(db_uri)
-        return sessionmaker(bind=Engine, expire_on_commit=False)
-    
-    db_uri = construct_db_uri()
-    Engine = create_async_engine(db_uri)
-    return sessionmaker(Engine, class_=AsyncSession, expire_on_commit=False)
+    return get_session_factory(construct_db_uri(_sync=_sync), _sync=_sync)
+
+def cache_lookup(cache, key):
+    value = cache.get(key)
+    CACHE_STATS['hits' if value is not None else 'misses'] += 1
+
+    return value
+
+def invalidate(username=None, asin=None):
+    if username is not None:
+        TRACKED_CACHE.pop(username, None)
+    if asin is not None:
+        PRODUCT_CACHE.pop(asin, None)
+
+    CACHE_STATS['invalidations'] += 1
+
+def cache_stats():
+    return {
+        **CACHE_STATS,
+        'users': len(USER_CACHE),
+        'products': len(PRODUCT_CACHE),
+        'tracked': len(TRACKED_CACHE)
+    }
+
+register_collector('db_cache', cache_stats)
+
+@timed('db_call')
+async def tracked_asins(username):
+    asins = cache_lookup(TRACKED_CACHE, username)
+
+    if asins is None:
+        async_session = make_session()
+        async with async_session() as session:
+            stmt = select(association_table.c.product_asin).where(association_table.c.username == username)
+            result = await session.execute(stmt)
+            asins = tuple(result.scalars())
+
+        TRACKED_CACHE[username] = asins
+
+    return asins
 
 async def is_associated(username, asin):
-    async_session = make_session()
-    async with async_session() as session:
-        stmt = select(association_table).where(association_table.c.username == username, association_table.c.product_asin == asin)
-        result = await session.execute(stmt)
-    
-    return True if result.scalar() else False
+    return asin in await tracked_asins(username)
 
 async def is_valid_request(username, asin):
-    async_session = make_session() 
-    async with async_session() as session:
-        stmt = select(association_table).where(association_table.c.username == username, association_table.c.product_asin == asin)
-        result = await session.execute(stmt)
-        
-    return False if result.scalar() else True
+    return not await is_associated(username, asin)
 
-async def request_limit_reached(username):
-    async_session = make_session() 
+@timed('db_call')
+async def tracked_count(username):
+    asins = TRACKED_CACHE.get(username)
+    if asins is not None:
+        return len(asins)
+
+    async_session = make_session()
     async with async_session() as session:
-        stmt = select(User).where(User.username == username).options(selectinload(User.products))
+        stmt = select(func.count()).select_from(association_table).where(association_table.c.username == username)
         result = await session.execute(stmt)
-        user = result.scalar()
-    
-    return True if len(user.products) == MAX_REQUESTS else False
 
+    return result.scalar()
+
+async def request_limit_reached(username, tracked=None):
+    if tracked is None:
+        tracked = await tracked_count(username)
+
+    return tracked >= MAX_REQUESTS
+
+@timed('db_call')
 async def create_user(user_info):
     first_name = user_info.first_name
     last_name = user_info.last_name
@@ -70,6 +117,7 @@ async def create_user(user_info):
 
     return user
 
+@timed('db_call')
 async def create_product(data):
     title = data['title']
     asin = data['asin']
@@ -79,46 +127,115 @@ async def create_product(data):
 
     async_session = make_session()
     async with async_session() as session:
-        product = Product(title=title, asin=asin, price=price, stock=stock, url=url)
+        product = Product(title=title, asin=asin, stock=stock, url=url)
+        set_price(product, price)
         session.add(product)
 
         await session.commit()
         
     return product
 
+def adopt_products_stmt(asins):
+    return update(Product).where(Product.asin.in_(asins), Product.orphaned_since.isnot(None)).values(orphaned_since=None).execution_options(synchronize_session=False)
+
+def orphan_products_stmt(asins):
+    # Only products nobody else tracks become clean_up candidates.
+    tracked = exists().where(association_table.c.product_asin == Product.asin)
+    return update(Product).where(Product.asin.in_(asins), ~tracked).values(orphaned_since=datetime.now()).execution_options(synchronize_session=False)
+
+@timed('db_call')
 async def create_association(username, asin):
     async_session = make_session()
     async with async_session() as session:
-        stmt = insert(association_table).values(username=username, product_asin=asin)
+        stmt = insert_ignore(association_table).values(username=username, product_asin=asin)
         await session.execute(stmt)
+        await session.execute(adopt_products_stmt([asin]))
 
         await session.commit()
 
+    invalidate(username=username)
+
+@timed('db_call')
 async def fetch_user(username):
+    user = cache_lookup(USER_CACHE, username)
+    if user is not None:
+        return user
+
     async_session = make_session()
     async with async_session() as session:
         stmt = select(User).where(User.username == username)
         result = await session.execute(stmt)
         user = result.scalar()
 
+    if user is not None:
+        USER_CACHE[username] = user
+
     return user
 
-async def fetch_product(asin):
+@timed('db_call')
+async def fetch_product(asin, cached=True):
+    product = cache_lookup(PRODUCT_CACHE, asin) if cached else None
+    if product is not None:
+        return product
+
     async_session = make_session()
     async with async_session() as session:
         stmt = select(Product).where(Product.asin == asin)
         result = await session.execute(stmt)
         product = result.scalar()
 
+    if product is not None:
+        PRODUCT_CACHE[asin] = product
+
     return product
 
-async def fetch_association(username, asin):
+@timed('db_call')
+async def fetch_products(asins):
+    products = {}
+    if not asins:
+        return products
+
     async_session = make_session()
     async with async_session() as session:
-        stmt = select(association_table).where(association_table.c.username == username, association_table.c.product_asin == asin)
+        stmt = select(Product).where(Product.asin.in_(asins))
         result = await session.execute(stmt)
+        products = {product.asin: product for product in result.scalars()}
 
-    return result.scalar()
+    PRODUCT_CACHE.update(products)
+    return products
+
+@timed('db_call')
+async def register_products(username, scraped, asins):
+    rows = []
+    for data in scraped:
+        product = set_price(Product(title=data['title'], asin=data['asin'], stock=data['stock'] or '', url=data['url']), data['price'])
+        rows.append({column: getattr(product, column) for column in NEW_PRODUCT_COLUMNS})
+
+    # Products and associations land in one transaction; insert_ignore absorbs
+    # a concurrent /track that inserted the same product or association first.
+    async_session = make_session()
+    async with async_session() as session:
+        if rows:
+            await session.execute(insert_ignore(Product.__table__), rows)
+
+        await session.execute(
+            insert_ignore(association_table),
+            [{'username': username, 'product_asin': asin} for asin in asins]
+        )
+        await session.execute(adopt_products_stmt(asins))
+
+        result = await session.execute(select(Product).where(Product.asin.in_(asins)))
+        products = {product.asin: product for product in result.scalars()}
+
+        await session.commit()
+
+    invalidate(username=username)
+    PRODUCT_CACHE.update(products)
+
+    return products
+
+async def fetch_association(username, asin):
+    return username if await is_associated(username, asin) else None
 
 async def fetch_or_create_user(user_info):
     user = await fetch_user(user_info.username)
@@ -150,49 +267,106 @@ async def save_to_database(data, user_info, obj=False):
 
 async def db_lookup(username, asin):
     if await is_associated(username, asin):
-        async_session = make_session()
-        async with async_session() as session:
-            stmt = select(Product).where(Product.asin == asin)
-            result = await session.execute(stmt)
-            product = result.scalar()
-
-        return product
+        return await fetch_product(asin)
 
     return None
 
+def cached_bulk_lookup(chat_id):
+    username = CHAT_CACHE.get(chat_id)
+    asins = TRACKED_CACHE.get(username) if username is not None else None
+    if asins is None:
+        return None
+
+    products = [PRODUCT_CACHE.get(asin) for asin in asins]
+    return products if None not in products else None
+
+@timed('db_call')
 async def db_bulk_lookup(chat_id):
-    async_session = make_session()
-    async with async_session() as session:
-        stmt = select(User).where(User.chat_id == chat_id).options(selectinload(User.products))
-        result = await session.execute(stmt)
-        products = result.scalar().products
+    products = cached_bulk_lookup(chat_id)
+    CACHE_STATS['hits' if products is not None else 'misses'] += 1
+
+    if products is None:
+        async_session = make_session()
+        async with async_session() as session:
+            stmt = select(User).where(User.chat_id == chat_id).options(selectinload(User.products))
+            result = await session.execute(stmt)
+            user = result.scalar()
+            products = user.products
+
+        CHAT_CACHE[chat_id] = user.username
+        TRACKED_CACHE[user.username] = tuple(product.asin for product in products)
+        PRODUCT_CACHE.update((product.asin, product) for product in products)
 
     if len(products) == 0:
         return None
 
     return products
 
+@timed('db_call')
 async def remove_association_entry(username, asin=None):
     async_session = make_session()
     async with async_session() as session:
         if asin is not None:
+            asins = [asin]
             stmt = association_table.delete().where(association_table.c.username == username, association_table.c.product_asin == asin)
         else:
+            result = await session.execute(select(association_table.c.product_asin).where(association_table.c.username == username))
+            asins = result.scalars().all()
             stmt = association_table.delete().where(association_table.c.username == username)
         
         await session.execute(stmt)
+        if asins:
+            await session.execute(orphan_products_stmt(asins))
+
         await session.commit()
 
+    invalidate(username=username)
+
 async def reassign_product(username, asin):
     already_associated = await fetch_association(username, asin)
 
     if already_associated:
         return None
 
-    product = await fetch_product(asin)
+    # clean_up runs in another process and may have deleted the product since
+    # it was cached, so the write path reads it from the database.
+    product = await fetch_product(asin, cached=False)
     if not product:
         data = await get_data(asin=asin)
         product = await create_product(data)
 
     await create_association(username, asin)
     return product
+
+@timed('db_call')
+async def products_with_price_drop(percent):
+    async_session = make_session()
+    async with async_session() as session:
+        stmt = select(Product).where(Product.price_change_bp <= -round(percent * 100)).order_by(Product.price_change_bp)
+        result = await session.execute(stmt)
+        products = result.scalars().all()
+
+    return products
+
+@timed('db_call')
+async def fetch_subscribers(price_asins, stock_asins):
+    price_asins, stock_asins = list(price_asins), list(stock_asins)
+    pairs = []
+
+    async_session = make_session()
+    async with async_session() as session:
+        # Chunked only to stay under SQLite's bound-parameter limit.
+        for start in range(0, max(len(price_asins), len(stock_asins)), BIND_PARAM_CHUNK):
+            price_chunk = price_asins[start:start + BIND_PARAM_CHUNK]
+            stock_chunk = stock_asins[start:start + BIND_PARAM_CHUNK]
+
+            stmt = select(association_table.c.product_asin, User.chat_id).join(
+                User, User.username == association_table.c.username
+            ).where(or_(
+                association_table.c.product_asin.in_(price_chunk),
+                and_(association_table.c.product_asin.in_(stock_chunk), User.stock_notification.is_(True))
+            ))
+            result = await session.execute(stmt)
+            pairs.extend(result.all())
+
+    return pairs
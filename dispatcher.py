@@ -0,0 +1,181 @@
+import time
+import asyncio
+import configparser
+
+from collections import deque
+
+from utils import send_once, construct_message, product_keyboard, MESSAGING_RETRY
+from scheduler import TokenBucket, percentile
+from metrics import register_collector, log_event
+
+
+CFG = configparser.ConfigParser()
+CFG.read('config.ini')
+DISPATCH_WORKERS = CFG.getint('settings', 'dispatch_workers', fallback=8)
+DISPATCH_GLOBAL_RATE = CFG.getfloat('settings', 'dispatch_global_rate', fallback=30)
+DISPATCH_CHAT_RATE = CFG.getfloat('settings', 'dispatch_chat_rate', fallback=1)
+DISPATCH_CHAT_BURST = CFG.getint('settings', 'dispatch_chat_burst', fallback=3)
+DISPATCH_MAX_QUEUE = CFG.getint('settings', 'dispatch_max_queue', fallback=10000)
+LATENCY_SAMPLES = 10000
+MAX_CHAT_BUCKETS = 50000
+
+_DISPATCHER = None
+_DISPATCHER_LOOP = None
+
+
+class Dispatcher:
+    def __init__(self, workers=DISPATCH_WORKERS, global_rate=DISPATCH_GLOBAL_RATE, chat_rate=DISPATCH_CHAT_RATE, chat_burst=DISPATCH_CHAT_BURST, max_queue=DISPATCH_MAX_QUEUE):
+        self.ready = asyncio.Queue()
+        self.lanes = {}
+        self.slots = asyncio.Semaphore(max_queue)
+        self.outstanding = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.pending = {}
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.latencies = []
+        self.stats = {'enqueued': 0, 'sent': 0, 'failed': 0, 'deduplicated': 0}
+        self.workers = [asyncio.create_task(self.work()) for _ in range(workers)]
+
+    async def enqueue(self, chat_id, text, key=None, reply_markup=None):
+        # An alert still waiting for the same chat and product is replaced by
+        # the newer text instead of queueing a second message.
+        if key is not None:
+            entry = self.pending.get((chat_id, key))
+            if entry is not None:
+                entry['text'] = text
+                entry['reply_markup'] = reply_markup
+                self.stats['deduplicated'] += 1
+                return
+
+        # Producers block once max_queue messages are outstanding.
+        await self.slots.acquire()
+
+        entry = {'chat_id': chat_id, 'text': text, 'key': key, 'reply_markup': reply_markup, 'enqueued_at': time.monotonic()}
+        if key is not None:
+            self.pending[(chat_id, key)] = entry
+
+        self.stats['enqueued'] += 1
+        self.outstanding += 1
+        self.idle.clear()
+
+        # A chat is handed to one worker at a time, so a burst for one chat
+        # waits in its own lane instead of holding every worker.
+        lane = self.lanes.get(chat_id)
+        if lane is None:
+            self.lanes[chat_id] = deque([entry])
+            self.ready.put_nowait(chat_id)
+        else:
+            lane.append(entry)
+
+    def chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                self.chat_buckets.clear()
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+
+        return self.chat_buckets[chat_id]
+
+    async def work(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            chat_id = await self.ready.get()
+
+            # A throttled chat is put back once its bucket refills rather
+            # than being waited on here.
+            wait = self.chat_bucket(chat_id).try_acquire()
+            if wait:
+                loop.call_later(wait, self.ready.put_nowait, chat_id)
+                continue
+
+            entry = self.lanes[chat_id].popleft()
+            try:
+                await self.deliver(entry)
+            finally:
+                self.finish(chat_id)
+
+    def finish(self, chat_id):
+        if self.lanes[chat_id]:
+            self.ready.put_nowait(chat_id)
+        else:
+            del self.lanes[chat_id]
+
+        self.slots.release()
+        self.outstanding -= 1
+        if not self.outstanding:
+            self.idle.set()
+
+    async def deliver(self, entry):
+        chat_id = entry['chat_id']
+        await self.global_bucket.acquire()
+
+        if entry['key'] is not None:
+            self.pending.pop((chat_id, entry['key']), None)
+
+        try:
+            await MESSAGING_RETRY.run(send_once, chat_id, entry['text'], reply_markup=entry['reply_markup'])
+            self.stats['sent'] += 1
+        except Exception as e:
+            self.stats['failed'] += 1
+            log_event('send_failed', chat_id=chat_id, error=str(e))
+
+        self.latencies.append(time.monotonic() - entry['enqueued_at'])
+        if len(self.latencies) > LATENCY_SAMPLES:
+            del self.latencies[:LATENCY_SAMPLES // 2]
+
+    async def drain(self):
+        await self.idle.wait()
+
+    async def close(self):
+        await self.drain()
+
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    def report(self):
+        return {
+            **self.stats,
+            'queue_depth': self.outstanding,
+            'p50_send_latency': percentile(self.latencies, 50),
+            'p95_send_latency': percentile(self.latencies, 95)
+        }
+
+
+def get_dispatcher(**options):
+    global _DISPATCHER, _DISPATCHER_LOOP
+    loop = asyncio.get_running_loop()
+
+    if _DISPATCHER is None or _DISPATCHER_LOOP is not loop:
+        _DISPATCHER = Dispatcher(**options)
+        _DISPATCHER_LOOP = loop
+
+    return _DISPATCHER
+
+async def dispatch(chat_id, text, key=None, reply_markup=None):
+    await get_dispatcher().enqueue(chat_id, text, key=key, reply_markup=reply_markup)
+
+async def dispatch_message(chat_id, obj, **kwargs):
+    await dispatch(chat_id, construct_message(obj, **kwargs), key=obj.asin, reply_markup=product_keyboard(obj.asin))
+
+async def drain_dispatcher():
+    if _DISPATCHER is not None and _DISPATCHER_LOOP is asyncio.get_running_loop():
+        await _DISPATCHER.drain()
+
+async def close_dispatcher():
+    global _DISPATCHER, _DISPATCHER_LOOP
+
+    if _DISPATCHER is not None and _DISPATCHER_LOOP is asyncio.get_running_loop():
+        await _DISPATCHER.close()
+
+    _DISPATCHER = None
+    _DISPATCHER_LOOP = None
+
+def dispatcher_stats():
+    return _DISPATCHER.report() if _DISPATCHER is not None else {}
+
+register_collector('dispatcher', dispatcher_stats)
@@ -0,0 +1,194 @@
+import re
+import configparser
+
+from html.parser import HTMLParser
+from bs4 import BeautifulSoup
+
+from metrics import log_event
+
+
+CFG = configparser.ConfigParser()
+CFG.read('config.ini')
+PRODUCT_TITLE = CFG['selectors']['product_title']
+PRODUCT_PRICE = CFG['selectors']['product_price']
+PRODUCT_STOCK = CFG['selectors']['product_stock']
+PARSER_BACKEND = CFG.get('settings', 'parser_backend', fallback='auto')
+
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+SIMPLE_SELECTOR = re.compile(r'^([a-zA-Z][a-zA-Z0-9-]*|\*)?((?:[#.][\w-]+)*)$')
+
+
+class UnsupportedSelector(ValueError):
+    pass
+
+
+class SoupExtractor:
+    name = 'soup'
+
+    def __init__(self, selectors):
+        self.selectors = selectors
+
+    def extract(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        data = {}
+
+        for field, selector in self.selectors.items():
+            element = soup.select_one(selector)
+            data[field] = element.text.strip() if element is not None else None
+
+        return data
+
+
+class LxmlExtractor:
+    name = 'lxml'
+
+    def __init__(self, selectors):
+        try:
+            from lxml import html as lxml_html
+            from lxml.cssselect import CSSSelector
+        except ImportError as e:
+            raise UnsupportedSelector(f"lxml backend unavailable: {e}")
+
+        self.parse = lxml_html.fromstring
+        self.selectors = {field: CSSSelector(selector) for field, selector in selectors.items()}
+
+    def extract(self, html):
+        try:
+            tree = self.parse(html)
+        except ValueError:
+            # lxml refuses str input that carries an XML encoding declaration.
+            tree = self.parse(html.encode('utf-8'))
+        data = {}
+
+        for field, selector in self.selectors.items():
+            elements = selector(tree)
+            data[field] = elements[0].text_content().strip() if elements else None
+
+        return data
+
+
+def compile_selector(selector):
+    # Only descendant chains of tag/#id/.class compounds are supported,
+    # which is all the product selectors need.
+    compiled = []
+
+    for part in selector.split():
+        match = SIMPLE_SELECTOR.match(part)
+        if match is None:
+            raise UnsupportedSelector(f"Streaming backend can't handle selector: {selector}")
+
+        tag = match.group(1) if match.group(1) not in (None, '*') else None
+        ids = re.findall(r'#([\w-]+)', match.group(2))
+        classes = set(re.findall(r'\.([\w-]+)', match.group(2)))
+        compiled.append((tag, ids[0] if ids else None, classes))
+
+    if not compiled:
+        raise UnsupportedSelector(f"Empty selector for streaming backend: {selector!r}")
+
+    return compiled
+
+def compound_matches(compound, element):
+    tag, element_id, classes = compound
+    return (tag is None or tag == element[0]) and (element_id is None or element_id == element[1]) and classes <= element[2]
+
+def selector_matches(compiled, stack):
+    if not compound_matches(compiled[-1], stack[-1]):
+        return False
+
+    position = len(compiled) - 2
+    for element in reversed(stack[:-1]):
+        if position < 0:
+            break
+        if compound_matches(compiled[position], element):
+            position -= 1
+
+    return position < 0
+
+
+class _StreamingParser(HTMLParser):
+    def __init__(self, selectors):
+        super().__init__(convert_charrefs=True)
+        self.selectors = selectors
+        self.stack = []
+        self.capturing = {}
+        self.data = {field: None for field in selectors}
+        self.remaining = set(selectors)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_ELEMENTS:
+            return
+
+        attributes = dict(attrs)
+        element = (tag, attributes.get('id'), set((attributes.get('class') or '').split()))
+        self.stack.append(element)
+
+        for field in self.remaining:
+            if field not in self.capturing and selector_matches(self.selectors[field], self.stack):
+                self.capturing[field] = (len(self.stack), [])
+
+    def handle_endtag(self, tag):
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index][0] == tag:
+                del self.stack[index:]
+                break
+        else:
+            return
+
+        for field, (depth, chunks) in list(self.capturing.items()):
+            if depth > len(self.stack):
+                self.data[field] = ''.join(chunks).strip()
+                self.remaining.discard(field)
+                del self.capturing[field]
+
+    def handle_data(self, data):
+        for _, chunks in self.capturing.values():
+            chunks.append(data)
+
+
+class StreamingExtractor:
+    name = 'streaming'
+    chunk_size = 32 * 1024
+
+    def __init__(self, selectors):
+        self.selectors = {field: compile_selector(selector) for field, selector in selectors.items()}
+
+    def extract(self, html):
+        parser = _StreamingParser(self.selectors)
+
+        # Stop feeding as soon as every field's element has been closed;
+        # product pages carry most of their weight after the buy box.
+        for offset in range(0, len(html), self.chunk_size):
+            parser.feed(html[offset:offset + self.chunk_size])
+            if not parser.remaining:
+                break
+
+        return parser.data
+
+
+BACKENDS = {
+    'soup': SoupExtractor,
+    'lxml': LxmlExtractor,
+    'streaming': StreamingExtractor
+}
+
+
+def build_extractor(backend=PARSER_BACKEND, selectors=None):
+    # The choice is made once here: a backend that accepts the selectors is
+    # trusted with every page, and only unsupported selectors fall back to soup.
+    selectors = selectors or {'title': PRODUCT_TITLE, 'price': PRODUCT_PRICE, 'stock': PRODUCT_STOCK}
+    candidates = ['lxml', 'streaming', 'soup'] if backend == 'auto' else [backend, 'soup']
+
+    for candidate in candidates:
+        try:
+            return BACKENDS[candidate](selectors)
+        except UnsupportedSelector as e:
+            log_event('extractor_unsupported', backend=candidate, error=str(e))
+
+    return SoupExtractor(selectors)
+
+
+EXTRACTOR = build_extractor()
+
+
+def extract_product_fields(html, extractor=None):
+    return (extractor or EXTRACTOR).extract(html)
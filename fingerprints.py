@@ -0,0 +1,104 @@
+import re
+import hashlib
+import functools
+import configparser
+
+from metrics import register_collector
+
+
+CFG = configparser.ConfigParser()
+CFG.read('config.ini')
+PRODUCT_TITLE = CFG['selectors']['product_title']
+PRODUCT_PRICE = CFG['selectors']['product_price']
+PRODUCT_STOCK = CFG['selectors']['product_stock']
+FINGERPRINT_WINDOW = CFG.getint('settings', 'fingerprint_window', fallback=8192)
+TAG_NAME = re.compile(rb'[A-Za-z][A-Za-z0-9]*')
+
+STATS = {'fetches': 0, 'not_modified': 0, 'fingerprint_hits': 0, 'misses': 0}
+
+
+def selector_anchors(selector):
+    # Each compound in a descendant selector becomes a byte anchor that has
+    # to appear after the previous one: its id attribute, else its last class.
+    anchors = []
+
+    for part in selector.split():
+        ids = re.findall(r'#([\w-]+)', part)
+        classes = re.findall(r'\.([\w-]+)', part)
+
+        if ids:
+            anchors.append(f'id="{ids[0]}"'.encode())
+        elif classes:
+            anchors.append(classes[-1].encode())
+
+    return anchors
+
+ANCHORS = [selector_anchors(selector) for selector in (PRODUCT_TITLE, PRODUCT_PRICE, PRODUCT_STOCK)]
+
+
+@functools.lru_cache(maxsize=None)
+def tag_pattern(name):
+    return re.compile(rb'<(/?)' + re.escape(name) + rb'[\s>/]')
+
+def element_end(body, position, limit):
+    # Walks from inside an element's opening tag to its matching closing
+    # tag, counting nested elements of the same name.
+    start = body.rfind(b'<', 0, position)
+    name = TAG_NAME.match(body, start + 1) if start != -1 else None
+    if name is None:
+        return -1
+
+    depth = 1
+    for tag in tag_pattern(name.group(0)).finditer(body, position, limit):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            return tag.end()
+
+    return -1
+
+def region_fingerprint(body, anchors=ANCHORS, window=FINGERPRINT_WINDOW):
+    digest = hashlib.blake2b(digest_size=16)
+
+    for chain in anchors:
+        if not chain:
+            return None
+
+        position = 0
+        for anchor in chain:
+            position = body.find(anchor, position)
+            if position == -1:
+                return None
+
+        # The whole element is hashed; one that doesn't close within the
+        # window gets no fingerprint, so the page is always parsed.
+        end = element_end(body, position, position + window)
+        if end == -1:
+            return None
+
+        digest.update(body[position:end])
+
+    return digest.hexdigest()
+
+def conditional_headers(validator):
+    headers = {}
+
+    if validator:
+        if validator.get('etag'):
+            headers['If-None-Match'] = validator['etag']
+        if validator.get('last_modified'):
+            headers['If-Modified-Since'] = validator['last_modified']
+
+    return headers
+
+def record(outcome):
+    STATS['fetches'] += 1
+    STATS[outcome] += 1
+
+def validator_stats(since=None):
+    # STATS counts from process start; a run passes its starting snapshot
+    # to get only its own share.
+    counts = {key: value - (since or {}).get(key, 0) for key, value in STATS.items()}
+    hits = counts['not_modified'] + counts['fingerprint_hits']
+    return {**counts, 'hit_rate': hits / counts['fetches'] if counts['fetches'] else 0.0}
+
+register_collector('page_cache', validator_stats)
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, delete
+
+from models import Lease
+from db_utils import make_session
+from storage import insert_ignore
+
+
+def acquire_lease(name, holder, ttl, now=None):
+    now = now or datetime.now()
+    expires_at = now + timedelta(seconds=ttl)
+
+    # Taking over an expired (or our own) lease and creating a missing one
+    # happen in the same write transaction, so only one holder can win.
+    sync_session = make_session(_sync=True)
+    with sync_session() as session:
+        result = session.execute(
+            update(Lease)
+            .where(Lease.name == name, (Lease.holder == holder) | (Lease.expires_at < now))
+            .values(holder=holder, expires_at=expires_at)
+            .execution_options(synchronize_session=False)
+        )
+        acquired = result.rowcount == 1
+
+        if not acquired:
+            result = session.execute(
+                insert_ignore(Lease.__table__),
+                {'name': name, 'holder': holder, 'expires_at': expires_at}
+            )
+            acquired = result.rowcount == 1
+
+        session.commit()
+
+    return acquired
+
+def release_lease(name, holder):
+    sync_session = make_session(_sync=True)
+    with sync_session() as session:
+        session.execute(delete(Lease).where(Lease.name == name, Lease.holder == holder).execution_options(synchronize_session=False))
+        session.commit()
@@ -0,0 +1,120 @@
+import string
+import configparser
+
+from datetime import datetime
+
+
+CFG = configparser.ConfigParser(interpolation=None)
+CFG.read('config.ini')
+
+NO_INFORMATION = 'No information...'
+MESSAGE_LIMIT = 4096
+DEFAULT_TEMPLATES = {
+    'price_alert': 'Update Alert! Price updated.\nLast checked: {time_since}\n\nTitle: {title}\n\nStock Status: {stock}\nPrevious Price: {old_price}\nUpdated Price: {price}\n\nBuy Now: {url}\n\n',
+    'stock_alert': 'Update Alert! Stock updated.\nLast checked: {time_since}\n\nTitle: {title}\n\nStock Status: {stock}\nPrevious Price: {old_price}\nUpdated Price: {price}\n\nBuy Now: {url}\n\n',
+    'update_alert': 'Update Alert! Price updated.\nLast checked: {time_since}\n\nTitle: {title}\n\nStock Status: {stock}\nPrice: {price}\n\nBuy Now: {url}\n\n',
+    'restart': 'Tracking Restarted!\nLast checked: {time_since}\n\nTitle: {title}\n\nStock Status: {stock}\nPrice: {price}\n\nBuy Now: {url}\n\n',
+    'admin': 'Admin Notification!\nLast checked: {time_since}\n\nTitle: {title}\n\nStock Status: {stock}\nPrice: {price}\n\nBuy Now: {url}\n\n',
+    'info': 'Last checked: {time_since}\n\nTitle: {title}\n\nStock Status: {stock}\nPrice: {price}\n\nBuy Now: {url}\n\n'
+}
+
+
+def compile_template(template):
+    # Split once into literal text and field names, so rendering is a single
+    # join instead of re-parsing the format string for every message.
+    parts = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        if literal:
+            parts.append((True, literal))
+        if field is not None:
+            parts.append((False, field))
+
+    return parts
+
+def load_templates():
+    templates = dict(DEFAULT_TEMPLATES)
+
+    if CFG.has_section('templates'):
+        for variant, template in CFG['templates'].items():
+            # Only \n and \t are unescaped, so non-ASCII text survives as is.
+            templates[variant] = template.replace('\\n', '\n').replace('\\t', '\t')
+
+    return {variant: compile_template(template) for variant, template in templates.items()}
+
+TEMPLATES = load_templates()
+
+
+def render_template(variant, values):
+    return ''.join(part if literal else str(values[part]) for literal, part in TEMPLATES[variant])
+
+def elapsed_time(start_time):
+    to_str = ''
+    interval = (datetime.now() - start_time).seconds
+
+    if interval // (60*60*24*365) > 0:
+        to_str += f"{ interval // (60*60*24*365) }yr "
+
+    if interval // (60*60*24) > 0:
+        to_str += f"{ (interval // (60*60*24))%365 }day "
+
+    if interval // (60*60) > 0:
+        to_str += f"{ (interval // (60*60))%(24) }hr "
+
+    if interval // (60) > 0:
+        to_str += f"{ (interval // (60))%(60) }min(s) ago"
+
+    if interval // 60 == 0:
+        to_str += f"just now"
+
+    return to_str
+
+def message_variant(old_price=None, auto_update=False, restart_updates=False, notify_admin=False, stock_update=False):
+    if auto_update:
+        if old_price not in [None, '']:
+            return 'price_alert'
+        elif stock_update:
+            return 'stock_alert'
+        return 'update_alert'
+
+    if restart_updates:
+        return 'restart'
+
+    if notify_admin:
+        return 'admin'
+
+    return 'info'
+
+def message_values(obj, old_price=None):
+    return {
+        'title': obj.title if obj.title != '' else NO_INFORMATION,
+        'price': obj.price if obj.price != '' else NO_INFORMATION,
+        'stock': obj.stock if obj.stock != '' else NO_INFORMATION,
+        'url': obj.url,
+        'old_price': old_price,
+        'time_since': elapsed_time(obj.last_checked)
+    }
+
+def construct_message(obj, old_price=None, auto_update=False, restart_updates=False, notify_admin=False, stock_update=False):
+    variant = message_variant(old_price, auto_update, restart_updates, notify_admin, stock_update)
+    return render_template(variant, message_values(obj, old_price))
+
+def combine_messages(parts, limit=MESSAGE_LIMIT):
+    # parts are (text, asin) pairs; each chunk keeps the ASINs whose text it
+    # carries so its keyboard can point back at them.
+    chunks = []
+    current, asins = '', []
+
+    for text, asin in parts:
+        if current and len(current) + len(text) > limit:
+            chunks.append((current, asins))
+            current, asins = '', []
+
+        current += text
+        if asin is not None:
+            asins.append(asin)
+
+    if current:
+        chunks.append((current, asins))
+
+    return chunks
+
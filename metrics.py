@@ -0,0 +1,187 @@
+import os
+import re
+import json
+import time
+import uuid
+import functools
+import contextvars
+import configparser
+
+
+CFG = configparser.ConfigParser()
+CFG.read('config.ini')
+METRICS_DIR = CFG.get('settings', 'metrics_dir', fallback='metrics')
+METRICS_FILE = CFG.get('settings', 'metrics_file', fallback='metrics-{pid}.prom')
+METRICS_DUMP_INTERVAL = CFG.getfloat('settings', 'metrics_dump_interval', fallback=60)
+JSON_LOGS = CFG.getboolean('settings', 'json_logs', fallback=True)
+
+# (name, labels) -> value / [count, sum, max]
+COUNTERS = {}
+TIMERS = {}
+COLLECTORS = {}
+RUN_ID = contextvars.ContextVar('run_id', default=None)
+_LAST_DUMP = [time.monotonic()]
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())) if labels else ())
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    entry = TIMERS.get(key)
+
+    if entry is None:
+        TIMERS[key] = [1, seconds, seconds]
+    else:
+        entry[0] += 1
+        entry[1] += seconds
+        if seconds > entry[2]:
+            entry[2] = seconds
+
+
+class timer:
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+        if exc_type is not None:
+            inc(f'{self.name}_errors', **self.labels)
+
+        maybe_dump()
+
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timer(name, function=func.__name__):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def register_collector(name, func):
+    COLLECTORS[name] = func
+
+def new_run_id():
+    run_id = uuid.uuid4().hex[:12]
+    RUN_ID.set(run_id)
+    return run_id
+
+def log_event(event, **fields):
+    if not JSON_LOGS:
+        print(f"{event}: {fields}")
+        return
+
+    print(json.dumps({'ts': round(time.time(), 3), 'event': event, 'run_id': RUN_ID.get(), 'pid': os.getpid(), **fields}, default=str))
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels):
+    if not labels:
+        return ''
+
+    rendered = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return '{' + rendered + '}'
+
+def _flatten(prefix, value, labels=()):
+    # Stats dicts from the other modules become gauges: nested keys join the
+    # name, and string fields of listed entries become labels.
+    if isinstance(value, bool):
+        yield prefix, labels, int(value)
+    elif isinstance(value, (int, float)):
+        yield prefix, labels, value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(f'{prefix}_{key}', item, labels)
+    elif isinstance(value, list):
+        for item in value:
+            if isinstance(item, dict):
+                item_labels = labels + tuple((key, field) for key, field in item.items() if isinstance(field, str))
+                yield from _flatten(prefix, {key: field for key, field in item.items() if not isinstance(field, str)}, item_labels)
+
+def prometheus_text():
+    lines = []
+
+    for (name, labels), value in sorted(COUNTERS.items()):
+        lines.append(f'{_metric_name(name)}_total{_labels(labels)} {value}')
+
+    for (name, labels), (count, total, longest) in sorted(TIMERS.items()):
+        metric = _metric_name(name)
+        lines.append(f'{metric}_seconds_count{_labels(labels)} {count}')
+        lines.append(f'{metric}_seconds_sum{_labels(labels)} {total:.6f}')
+        lines.append(f'{metric}_seconds_max{_labels(labels)} {longest:.6f}')
+
+    for collector, func in COLLECTORS.items():
+        try:
+            stats = func()
+        except Exception as e:
+            log_event('metrics_collector_failed', collector=collector, error=str(e))
+            continue
+
+        for name, labels, value in _flatten(collector, stats):
+            lines.append(f'{_metric_name(name)}{_labels(labels)} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+def prune_stale():
+    # Every process writes its own file, so files left by exited Celery
+    # children and bench runs are dropped here.
+    prefix, _, suffix = METRICS_FILE.partition('{pid}')
+    for name in os.listdir(METRICS_DIR):
+        pid = name[len(prefix):len(name) - len(suffix)]
+        if name.startswith(prefix) and name.endswith(suffix) and pid.isdigit() and not _alive(int(pid)):
+            try:
+                os.remove(os.path.join(METRICS_DIR, name))
+            except OSError:
+                pass
+
+def dump(path=None):
+    if path is None:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        prune_stale()
+        path = os.path.join(METRICS_DIR, METRICS_FILE.format(pid=os.getpid()))
+    temporary = f'{path}.tmp'
+
+    # Written aside and renamed so a scraper never reads half a file.
+    with open(temporary, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(temporary, path)
+
+    _LAST_DUMP[0] = time.monotonic()
+    return path
+
+def maybe_dump():
+    if time.monotonic() - _LAST_DUMP[0] >= METRICS_DUMP_INTERVAL:
+        try:
+            dump()
+        except OSError as e:
+            _LAST_DUMP[0] = time.monotonic()
+            log_event('metrics_dump_failed', error=str(e))
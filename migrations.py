@@ -0,0 +1,134 @@
+from datetime import datetime
+from sqlalchemy import inspect, text
+
+from db_utils import construct_db_uri
+from db_engine import get_engine
+from storage import is_sqlite
+from models import Base, PriceHistory, Lease
+from polling import MIN_CHECK_INTERVAL
+from utils import parse_price
+
+
+def column_names(conn, table):
+    return {column['name'] for column in inspect(conn).get_columns(table)}
+
+def add_column(conn, table, name, ddl):
+    if name not in column_names(conn, table):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+def migrate_polling_schedule(conn):
+    add_column(conn, 'products', 'next_check', 'DATETIME')
+    add_column(conn, 'products', 'check_interval', f'INTEGER DEFAULT {MIN_CHECK_INTERVAL}')
+    add_column(conn, 'products', 'change_score', 'FLOAT DEFAULT 0')
+
+    conn.execute(text("UPDATE products SET next_check = last_checked WHERE next_check IS NULL"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_next_check ON products (next_check)"))
+
+def migrate_page_validators(conn):
+    add_column(conn, 'products', 'page_etag', 'VARCHAR')
+    add_column(conn, 'products', 'page_last_modified', 'VARCHAR')
+    add_column(conn, 'products', 'page_fingerprint', 'VARCHAR')
+
+def migrate_normalized_price(conn):
+    add_column(conn, 'products', 'price_cents', 'INTEGER')
+    add_column(conn, 'products', 'currency', 'VARCHAR(3)')
+    add_column(conn, 'products', 'previous_price_cents', 'INTEGER')
+    add_column(conn, 'products', 'price_change_bp', 'INTEGER DEFAULT 0')
+
+    rows = conn.execute(text("SELECT id, price FROM products WHERE price_cents IS NULL")).all()
+    params = []
+    for product_id, price in rows:
+        price_cents, currency = parse_price(price)
+        params.append({'_id': product_id, 'price_cents': price_cents, 'currency': currency})
+
+    if params:
+        stmt = text("UPDATE products SET price_cents = :price_cents, previous_price_cents = :price_cents, currency = :currency, price_change_bp = 0 WHERE id = :_id")
+        conn.execute(stmt, params)
+
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_price_cents ON products (price_cents)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_price_change_bp ON products (price_change_bp)"))
+
+def migrate_price_history(conn):
+    PriceHistory.__table__.create(conn, checkfirst=True)
+
+def migrate_priced_samples(conn):
+    add_column(conn, 'price_history', 'priced_samples', 'INTEGER')
+
+    # Buckets compacted before the column existed are taken as fully priced.
+    conn.execute(text("UPDATE price_history SET priced_samples = samples WHERE span IS NOT NULL AND priced_samples IS NULL AND price_cents IS NOT NULL"))
+
+def migrate_association_indexes(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_association_product_asin ON association_table (product_asin)"))
+
+def migrate_association_primary_key(conn):
+    # The composite primary key covers (username, product_asin) lookups.
+    conn.execute(text("DROP INDEX IF EXISTS ix_association_username_asin"))
+
+    if inspect(conn).get_pk_constraint('association_table')['constrained_columns']:
+        return
+
+    # SQLite can't add a primary key in place, so the table is rebuilt and
+    # duplicate rows collapse on the way over.
+    conn.execute(text(
+        "CREATE TABLE association_table_new ("
+        "username VARCHAR NOT NULL, "
+        "product_asin VARCHAR NOT NULL, "
+        "PRIMARY KEY (username, product_asin), "
+        "FOREIGN KEY(username) REFERENCES users (username), "
+        "FOREIGN KEY(product_asin) REFERENCES products (asin)"
+        ") WITHOUT ROWID"
+    ))
+    conn.execute(text(
+        "INSERT OR IGNORE INTO association_table_new (username, product_asin) "
+        "SELECT DISTINCT username, product_asin FROM association_table "
+        "WHERE username IS NOT NULL AND product_asin IS NOT NULL"
+    ))
+    conn.execute(text("DROP TABLE association_table"))
+    conn.execute(text("ALTER TABLE association_table_new RENAME TO association_table"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_association_product_asin ON association_table (product_asin)"))
+
+def migrate_leases(conn):
+    Lease.__table__.create(conn, checkfirst=True)
+
+def migrate_orphaned_since(conn):
+    add_column(conn, 'products', 'orphaned_since', 'DATETIME')
+
+    conn.execute(text(
+        "UPDATE products SET orphaned_since = :now "
+        "WHERE orphaned_since IS NULL AND NOT EXISTS "
+        "(SELECT 1 FROM association_table WHERE association_table.product_asin = products.asin)"
+    ), {'now': datetime.now()})
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_orphaned_since ON products (orphaned_since)"))
+
+
+MIGRATIONS = [
+    migrate_polling_schedule,
+    migrate_page_validators,
+    migrate_normalized_price,
+    migrate_price_history,
+    migrate_priced_samples,
+    migrate_association_indexes,
+    migrate_association_primary_key,
+    migrate_leases,
+    migrate_orphaned_since,
+]
+
+
+def migrate():
+    db_uri = construct_db_uri(_sync=True)
+    engine = get_engine(db_uri, _sync=True)
+
+    # The migrations upgrade legacy SQLite files in place; any other backend
+    # starts out with the current schema.
+    if not is_sqlite(db_uri):
+        Base.metadata.create_all(engine)
+        return
+
+    with engine.begin() as conn:
+        for migration in MIGRATIONS:
+            print(f"Applying {migration.__name__}")
+            migration(conn)
+
+
+if __name__ == '__main__':
+    migrate()
@@ -1,23 +1,29 @@
 from datetime import datetime
-from sqlalchemy import create_engine, Table, Column, Integer, String, Boolean, DateTime, ForeignKey
+from sqlalchemy import Table, Index, Column, Integer, BigInteger, SmallInteger, Float, String, Boolean, DateTime, ForeignKey
 from sqlalchemy.orm import declarative_base, relationship
 
+from storage import database_uri
+from db_engine import get_engine
 
-Engine = create_engine("sqlite:///db.sqlite3")
+
+Engine = get_engine(database_uri(_sync=True), _sync=True)
 Base = declarative_base()
 
 
 association_table = Table(
     'association_table',
     Base.metadata,
-    Column('username', String, ForeignKey('users.username')),
-    Column('product_asin', String, ForeignKey('products.asin'))
+    Column('username', String, ForeignKey('users.username'), primary_key=True),
+    Column('product_asin', String, ForeignKey('products.asin'), primary_key=True),
+    Index('ix_association_product_asin', 'product_asin'),
+    sqlite_with_rowid=False
 )
 
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True)
-    chat_id = Column(Integer, unique=True, nullable=False)
+    # Telegram IDs outgrow 32 bits, and supergroup IDs are large negatives.
+    chat_id = Column(BigInteger, unique=True, nullable=False)
     first_name = Column(String)
     last_name = Column(String)
     username = Column(String, unique=True, nullable=False)
@@ -33,10 +39,41 @@ class Product(Base):
     title = Column(String, nullable=False)
     asin = Column(String, unique=True, nullable=False)
     price = Column(String, nullable=False)
+    price_cents = Column(Integer, index=True)
+    currency = Column(String(3))
+    previous_price_cents = Column(Integer)
+    price_change_bp = Column(Integer, default=0, index=True)
     stock = Column(String, nullable=False)
     url = Column(String, nullable=False)
     last_checked = Column(DateTime, default=datetime.now)
     last_updated = Column(DateTime, default=datetime.now)
+    next_check = Column(DateTime, default=datetime.now, index=True)
+    check_interval = Column(Integer)
+    change_score = Column(Float, default=0)
+    page_etag = Column(String)
+    page_last_modified = Column(String)
+    page_fingerprint = Column(String)
+    orphaned_since = Column(DateTime, index=True)
+
+class PriceHistory(Base):
+    __tablename__ = "price_history"
+    __table_args__ = {'sqlite_with_rowid': False}
+    product_id = Column(Integer, ForeignKey('products.id'), primary_key=True)
+    recorded_at = Column(Integer, primary_key=True)
+    price_cents = Column(Integer)
+    stock = Column(SmallInteger, nullable=False, default=0)
+    # Only set on downsampled rows; raw observations leave them NULL.
+    min_cents = Column(Integer)
+    max_cents = Column(Integer)
+    samples = Column(Integer)
+    priced_samples = Column(Integer)
+    span = Column(Integer)
+
+class Lease(Base):
+    __tablename__ = "leases"
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,59 @@
+import asyncio
+import configparser
+
+from concurrent.futures import ProcessPoolExecutor
+
+from extractors import extract_product_fields
+from metrics import log_event
+
+
+CFG = configparser.ConfigParser()
+CFG.read('config.ini')
+PARSE_WORKERS = CFG.getint('settings', 'parse_workers', fallback=0)
+PARSE_POOL_MIN_CATALOG = CFG.getint('settings', 'parse_pool_min_catalog', fallback=500)
+
+_POOL = None
+
+
+def start_parse_pool(workers=PARSE_WORKERS):
+    global _POOL
+
+    if _POOL is not None:
+        return True
+
+    if workers <= 0:
+        return False
+
+    try:
+        _POOL = ProcessPoolExecutor(max_workers=workers)
+    except OSError as e:
+        log_event('parse_pool_unavailable', workers=workers, error=str(e))
+        return False
+
+    return True
+
+def shutdown_parse_pool(wait=True):
+    global _POOL
+
+    if _POOL is not None:
+        _POOL.shutdown(wait=wait)
+        _POOL = None
+
+def parse_body(body, encoding):
+    return extract_product_fields(body.decode(encoding, errors='replace'))
+
+async def extract_fields(body, encoding):
+    if _POOL is None:
+        return parse_body(body, encoding)
+
+    # Only the raw bytes go out and the three-field dict comes back, which
+    # keeps pickling cost far below the parse it saves.
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_POOL, parse_body, body, encoding)
+    except Exception as e:
+        # Worker processes are spawned lazily, so this is also where a
+        # daemonic Celery prefork child finds out it can't have children.
+        log_event('parse_pool_failed', error=str(e))
+        shutdown_parse_pool(wait=False)
+        return parse_body(body, encoding)
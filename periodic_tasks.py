@@ -1,114 +1,331 @@
 import asyncio
 import configparser
 
-from datetime import datetime
-from sqlalchemy.orm import selectinload
+from datetime import datetime, timedelta
+from sqlalchemy import func, delete, update, exists
 from sqlalchemy.future import select
-from sqlalchemy.orm.collections import InstrumentedList
 
-from utils import get_data, get_comparable_price, send_message
-from models import Product
-from db_utils import make_session
+from utils import get_data, parse_price, set_price, product_keyboard, close_bot
+from models import Product, PriceHistory, association_table
+from db_utils import make_session, fetch_subscribers, invalidate, BIND_PARAM_CHUNK
+from db_engine import dispose_async_engines
+from scraper_client import close_client_session
+from scheduler import run_bounded
+from polling import reschedule
+from write_batcher import WriteBatcher
+from parse_pool import start_parse_pool, PARSE_POOL_MIN_CATALOG
+from fingerprints import validator_stats
+from price_history import history_row, compact_price_history
+from dispatcher import get_dispatcher, dispatch, drain_dispatcher, close_dispatcher, dispatcher_stats, DISPATCH_GLOBAL_RATE
+from messages import construct_message
+from metrics import timer, inc, new_run_id, log_event, dump
 
 
 CFG = configparser.ConfigParser()
 CFG.read('config.ini')
 URL_PREFIX = CFG['settings']['url_prefix']
 URL_SUFFIX = CFG['settings']['url_suffix']
+UPDATER_CONCURRENCY = CFG.getint('settings', 'updater_concurrency', fallback=20)
+SCRAPER_RATE_PER_HOST = CFG.getfloat('settings', 'scraper_rate_per_host', fallback=5)
+SCRAPER_BURST = CFG.getint('settings', 'scraper_burst', fallback=10)
+UPDATER_CLAIM_TTL = CFG.getint('settings', 'updater_claim_ttl', fallback=900)
+CLEAN_UP_CHUNK = CFG.getint('settings', 'clean_up_chunk', fallback=500)
+SCHEDULE_COLUMNS = ('last_checked', 'next_check', 'check_interval', 'change_score')
+PRICE_COLUMNS = ('price', 'price_cents', 'currency', 'previous_price_cents', 'price_change_bp')
+VALIDATOR_COLUMNS = ('page_etag', 'page_last_modified', 'page_fingerprint')
+ADMIN_CHAT_ID = 1398539513
 
 
-async def save_updated_product_data(product_obj, updated_data, session=None):
-    if session is None:
-        async_session = make_session()
-        async with async_session() as session:
-            return await save_updated_product_data(product_obj, updated_data, session)
-    else:
-        session.add(product_obj)
+class UpdateRun:
+    def __init__(self, batcher, history):
+        self.batcher = batcher
+        self.history = history
+        self.rendered = 0
+        self.alerts = {}
+        self.alerted = 0
+        self.withheld = 0
 
-        product_obj.title = updated_data['title']
-        product_obj.price = updated_data['price']
-        product_obj.stock = updated_data['stock']
-        product_obj.last_checked = datetime.now()
-        product_obj.last_updated = datetime.now()
-        
-        await session.commit()
+    async def queue_alert(self, product_obj, text, stock_update):
+        self.alerts[product_obj.asin] = (product_obj.id, text, stock_update)
+
+        if len(self.alerts) >= BIND_PARAM_CHUNK:
+            await self.flush_alerts()
+
+    async def flush_alerts(self):
+        alerts, self.alerts = self.alerts, {}
+        if not alerts:
+            return
+
+        # The changes behind these alerts are written first. A change whose
+        # write failed is still the old value in the database, so the next
+        # run finds it again and alerts then instead of twice.
+        failed = await self.batcher.barrier()
+        withheld = [asin for asin, (product_id, _, _) in alerts.items() if product_id in failed]
+        for asin in withheld:
+            del alerts[asin]
+        self.withheld += len(withheld)
+
+        # One joined query resolves every watcher of every changed product;
+        # stock-only changes skip users who turned stock alerts off.
+        price_asins = [asin for asin, (_, _, stock_update) in alerts.items() if not stock_update]
+        stock_asins = [asin for asin, (_, _, stock_update) in alerts.items() if stock_update]
+
+        keyboards = {asin: product_keyboard(asin) for asin in alerts}
+
+        for asin, chat_id in await fetch_subscribers(price_asins, stock_asins):
+            await dispatch(chat_id, alerts[asin][1], key=asin, reply_markup=keyboards[asin])
+            self.alerted += 1
+
+
+def product_row(product_obj, *columns):
+    return {'id': product_obj.id, **{column: getattr(product_obj, column) for column in columns}}
+
+async def save_updated_product_data(product_obj, updated_data, run, watchers=1):
+    product_obj.title = updated_data['title']
+    set_price(product_obj, updated_data['price'], updated_data['price_cents'], updated_data['currency'])
+    product_obj.stock = updated_data['stock']
+    product_obj.last_checked = datetime.now()
+    product_obj.last_updated = datetime.now()
+    reschedule(product_obj, True, watchers, now=product_obj.last_checked)
+
+    await run.batcher.put(product_row(product_obj, 'title', 'stock', *PRICE_COLUMNS, *SCHEDULE_COLUMNS, *VALIDATOR_COLUMNS, 'last_updated'))
+    invalidate(asin=product_obj.asin)
 
     return product_obj
 
-async def prepare_update_message(product_obj, updated_data):
+async def prepare_update_message(product_obj, updated_data, run, watchers=1):
     old_price = product_obj.price
-    users = InstrumentedList()
-    stock_update = False
+    price_update = updated_data['price_cents'] != product_obj.price_cents
+    stock_update = not price_update and updated_data['stock'] != product_obj.stock
 
-    async_session = make_session()
-    async with async_session() as session:
-        if get_comparable_price(updated_data['price']) != get_comparable_price(product_obj.price):
-            stmt = select(Product).where(Product.asin == product_obj.asin).options(selectinload(Product.users))
-            result = await session.execute(stmt)
-            users = result.scalar().users
-        elif updated_data['stock'] != product_obj.stock:
-            stock_update = True
-            stmt = select(Product).where(Product.asin == product_obj.asin).options(selectinload(Product.users))
-            result = await session.execute(stmt)
+    obj = await save_updated_product_data(product_obj, updated_data, run, watchers)
+
+    if price_update or stock_update:
+        # Rendered once here; every watcher's alert reuses the text.
+        text = construct_message(obj, old_price=old_price, auto_update=True, stock_update=stock_update)
+        run.rendered += 1
+        await run.queue_alert(obj, text, stock_update)
 
-            for user in result.scalar().users:
-                if user.stock_notification:
-                    users.append(user)
+async def notify_admin(obj, run):
+    await dispatch(ADMIN_CHAT_ID, construct_message(obj, notify_admin=True), key=obj.asin, reply_markup=product_keyboard(obj.asin))
 
-        obj = await save_updated_product_data(product_obj, updated_data, session)
+def page_validator(product_obj):
+    return {'etag': product_obj.page_etag, 'last_modified': product_obj.page_last_modified, 'fingerprint': product_obj.page_fingerprint}
 
-    for user in users:
-        await send_message(user.chat_id, obj, old_price=old_price, auto_update=True, stock_update=stock_update)
+def store_page_validator(product_obj, validator):
+    product_obj.page_etag = validator['etag']
+    product_obj.page_last_modified = validator['last_modified']
+    product_obj.page_fingerprint = validator['fingerprint']
 
-async def notify_admin(obj):
-    await send_message(1398539513, obj, notify_admin=True)
+async def mark_unchanged(product_obj, run, watchers):
+    product_obj.last_checked = datetime.now()
+    reschedule(product_obj, False, watchers, now=product_obj.last_checked)
+    columns = [*SCHEDULE_COLUMNS, *VALIDATOR_COLUMNS]
 
-async def check_for_update(product_obj):
-    data = await get_data(url=product_obj.url)
+    # The price held since the previous check, so the drop marker resets.
+    if product_obj.price_change_bp:
+        product_obj.previous_price_cents = product_obj.price_cents
+        product_obj.price_change_bp = 0
+        columns += ['previous_price_cents', 'price_change_bp']
+
+    await run.batcher.put(product_row(product_obj, *columns))
     
+    if product_obj.asin in ['B086PKMZ21', 'B098RDFP3J']:
+        await notify_admin(product_obj, run)
+
+    return False
+
+async def check_for_update(product_obj, run, watchers=1):
+    changed = await detect_update(product_obj, run, watchers)
+    await run.history.put(history_row(product_obj))
+
+    return changed
+
+async def detect_update(product_obj, run, watchers=1):
+    data = await get_data(url=product_obj.url, validator=page_validator(product_obj))
+    if data is None:
+        raise RuntimeError(f"Couldn't fetch product data for {product_obj.asin}")
+
+    if not data.get('unchanged'):
+        # A page without a title is a captcha or error page rather than the
+        # product, while a missing price or stock keeps the stored value.
+        if data['title'] is None:
+            raise RuntimeError(f"Couldn't find a title for {product_obj.asin}")
+        if data['price'] is None:
+            data['price'] = product_obj.price
+        if data['stock'] is None:
+            data['stock'] = product_obj.stock
+
+    store_page_validator(product_obj, data['validator'])
+    if data.get('unchanged'):
+        return await mark_unchanged(product_obj, run, watchers)
+
     title = data['title']
     price = data['price']
     stock = data['stock']
+    data['price_cents'], data['currency'] = parse_price(price)
 
-    if title != product_obj.title or get_comparable_price(price) != get_comparable_price(product_obj.price) or stock != product_obj.stock:
+    if title != product_obj.title or data['price_cents'] != product_obj.price_cents or stock != product_obj.stock:
         if title == product_obj.title:
             if stock != product_obj.stock or price != '':
-                await prepare_update_message(product_obj, data)
-                return
+                await prepare_update_message(product_obj, data, run, watchers)
+                return True
         
-        await save_updated_product_data(product_obj, data)
-        return
-    
-    async_session = make_session()
-    async with async_session() as session:
-        session.add(product_obj)
-        product_obj.last_checked = datetime.now()
+        await save_updated_product_data(product_obj, data, run, watchers)
+        return True
 
-        await session.commit()
-    
-    if product_obj.asin in ['B086PKMZ21', 'B098RDFP3J']:
-        await notify_admin(product_obj)
+    return await mark_unchanged(product_obj, run, watchers)
+
+async def fetch_due_products(now=None, asins=None):
+    watchers = select(func.count()).where(association_table.c.product_asin == Product.asin).scalar_subquery()
+
+    # A shard gets its ASINs from the coordinator, which already claimed them.
+    if asins is not None:
+        condition = Product.asin.in_(asins)
+    else:
+        condition = Product.next_check <= (now or datetime.now())
 
-async def check_for_update_all():
     async_session = make_session()
     async with async_session() as session:
-        stmt = select(Product)
+        stmt = select(Product, watchers).where(condition).order_by(Product.next_check)
         result = await session.execute(stmt)
-        all_products = result.scalars()
+        due_products = result.all()
 
-    tasks = [check_for_update(product) for product in all_products]    
-    return await asyncio.gather(*tasks)
+    return due_products
 
-def updater():
-    asyncio.run(check_for_update_all())
+def claim_due_asins(now=None, chunk_size=BIND_PARAM_CHUNK):
+    now = now or datetime.now()
 
-def clean_up():
+    # Pushing next_check past the claim window keeps a later coordinator from
+    # handing the same products out again; a shard that dies just lets the
+    # claim lapse and the products come due again.
     sync_session = make_session(_sync=True)
     with sync_session() as session:
-        all_products = session.query(Product)
+        asins = session.execute(select(Product.asin).where(Product.next_check <= now).order_by(Product.next_check)).scalars().all()
 
-        for product in all_products:
-            if len(product.users) == 0:
-                session.delete(product)
+        for start in range(0, len(asins), chunk_size):
+            chunk = asins[start:start + chunk_size]
+            session.execute(
+                update(Product)
+                .where(Product.asin.in_(chunk))
+                .values(next_check=now + timedelta(seconds=UPDATER_CLAIM_TTL))
+                .execution_options(synchronize_session=False)
+            )
 
         session.commit()
+
+    return asins
+
+async def check_for_update_all(asins=None, share=1):
+    due_products = await fetch_due_products(asins=asins)
+    page_cache = validator_stats()
+
+    # Shards running side by side split the Amazon and Telegram limits, so
+    # together they stay within what a single updater would send.
+    get_dispatcher(global_rate=DISPATCH_GLOBAL_RATE / share)
+
+    # Small runs aren't worth the inter-process hop, so they parse inline.
+    if len(due_products) >= PARSE_POOL_MIN_CATALOG:
+        start_parse_pool()
+
+    async with WriteBatcher(make_session(), Product.__table__) as batcher, WriteBatcher(make_session(), PriceHistory.__table__, append=True) as history:
+        run = UpdateRun(batcher, history)
+        summary = await run_bounded(
+            due_products,
+            lambda item: check_for_update(item[0], run, item[1]),
+            UPDATER_CONCURRENCY,
+            SCRAPER_RATE_PER_HOST / share,
+            max(1, SCRAPER_BURST // share),
+            get_url=lambda item: item[0].url
+        )
+        await run.flush_alerts()
+
+    await drain_dispatcher()
+
+    summary['writes'] = batcher.stats
+    summary['history_writes'] = history.stats
+    summary['page_cache'] = validator_stats(since=page_cache)
+    summary['notifications'] = dispatcher_stats()
+    summary['messages'] = {'rendered': run.rendered, 'alerts': run.alerted, 'withheld': run.withheld}
+    return summary
+
+async def run_update_cycle(asins=None, share=1):
+    try:
+        return await check_for_update_all(asins, share)
+    finally:
+        await close_dispatcher()
+        await close_bot()
+        await close_client_session()
+        await dispose_async_engines()
+
+def updater(asins=None, share=1):
+    new_run_id()
+    with timer('updater_run'):
+        summary = asyncio.run(run_update_cycle(asins, share))
+
+    for key in ('checked', 'changed', 'failed'):
+        inc(f'updater_products_{key}', summary[key])
+
+    log_event('updater_run', **summary)
+    dump()
+    return summary
+
+def merge_summaries(summaries):
+    merged = {}
+
+    for summary in summaries:
+        for key, value in (summary or {}).items():
+            if isinstance(value, dict):
+                merged[key] = merge_summaries([merged.get(key, {}), value])
+            elif key == 'duration' or key.startswith('p50') or key.startswith('p95'):
+                # Shards run side by side, so the slowest one stands for the run.
+                merged[key] = max(merged.get(key, 0), value)
+            elif isinstance(value, (int, float)):
+                merged[key] = merged.get(key, 0) + value
+
+    if 'hit_rate' in merged and merged.get('fetches'):
+        merged['hit_rate'] = (merged['not_modified'] + merged['fingerprint_hits']) / merged['fetches']
+
+    return merged
+
+def delete_orphans(session, product_ids):
+    # Candidates are re-checked here, so a product someone tracked again since
+    # being marked just has its marker cleared.
+    tracked = exists().where(association_table.c.product_asin == Product.asin)
+    orphan_ids = session.execute(select(Product.id).where(Product.id.in_(product_ids), ~tracked)).scalars().all()
+
+    session.execute(update(Product).where(Product.id.in_(product_ids), tracked).values(orphaned_since=None).execution_options(synchronize_session=False))
+    if orphan_ids:
+        session.execute(delete(PriceHistory).where(PriceHistory.product_id.in_(orphan_ids)).execution_options(synchronize_session=False))
+        session.execute(delete(Product).where(Product.id.in_(orphan_ids)).execution_options(synchronize_session=False))
+
+    return len(orphan_ids)
+
+def clean_up(now=None):
+    cutoff = now or datetime.now()
+    stats = {'candidates': 0, 'deleted': 0}
+    last_id = 0
+
+    # Only products marked by remove_association_entry are looked at, a chunk
+    # per short transaction so the updater's writes can interleave.
+    new_run_id()
+    sync_session = make_session(_sync=True)
+    while True:
+        with sync_session() as session:
+            stmt = select(Product.id).where(Product.orphaned_since <= cutoff, Product.id > last_id).order_by(Product.id).limit(CLEAN_UP_CHUNK)
+            product_ids = session.execute(stmt).scalars().all()
+            if not product_ids:
+                break
+
+            stats['candidates'] += len(product_ids)
+            stats['deleted'] += delete_orphans(session, product_ids)
+            last_id = product_ids[-1]
+
+            session.commit()
+
+    with timer('price_history_compaction'):
+        compaction = compact_price_history()
+
+    inc('orphaned_products_deleted', stats['deleted'])
+    log_event('clean_up', orphans=stats, compaction=compaction)
+    dump()
@@ -0,0 +1,39 @@
+import math
+import random
+import configparser
+
+from datetime import datetime, timedelta
+
+
+CFG = configparser.ConfigParser()
+CFG.read('config.ini')
+MIN_CHECK_INTERVAL = CFG.getint('settings', 'min_check_interval', fallback=300)
+MAX_CHECK_INTERVAL = CFG.getint('settings', 'max_check_interval', fallback=6*60*60)
+CHANGE_SCORE_DECAY = CFG.getfloat('settings', 'change_score_decay', fallback=0.3)
+CHECK_INTERVAL_JITTER = CFG.getfloat('settings', 'check_interval_jitter', fallback=0.1)
+
+
+def update_change_score(change_score, changed):
+    # Exponentially weighted change rate: 1.0 means every recent check saw a change.
+    return CHANGE_SCORE_DECAY * (1 if changed else 0) + (1 - CHANGE_SCORE_DECAY) * (change_score or 0)
+
+def next_check_interval(change_score, watchers):
+    if watchers == 0:
+        return MAX_CHECK_INTERVAL
+
+    # Interpolate geometrically between the slowest and fastest tier, then
+    # pull popular products forward since an alert reaches more people.
+    interval = MAX_CHECK_INTERVAL * (MIN_CHECK_INTERVAL / MAX_CHECK_INTERVAL) ** change_score
+    interval /= 1 + math.log2(watchers)
+    interval *= random.uniform(1 - CHECK_INTERVAL_JITTER, 1 + CHECK_INTERVAL_JITTER)
+
+    return int(min(MAX_CHECK_INTERVAL, max(MIN_CHECK_INTERVAL, interval)))
+
+def reschedule(product_obj, changed, watchers, now=None):
+    now = now or datetime.now()
+
+    product_obj.change_score = update_change_score(product_obj.change_score, changed)
+    product_obj.check_interval = next_check_interval(product_obj.change_score, watchers)
+    product_obj.next_check = now + timedelta(seconds=product_obj.check_interval)
+
+    return product_obj
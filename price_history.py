@@ -0,0 +1,153 @@
+import time
+import configparser
+
+from sqlalchemy import func, case, delete, insert, and_, not_, exists
+from sqlalchemy.future import select
+
+from models import Product, PriceHistory
+from db_utils import make_session
+
+
+CFG = configparser.ConfigParser()
+CFG.read('config.ini')
+HISTORY_RAW_DAYS = CFG.getint('settings', 'history_raw_days', fallback=2)
+HISTORY_HOURLY_DAYS = CFG.getint('settings', 'history_hourly_days', fallback=30)
+HISTORY_RETENTION_DAYS = CFG.getint('settings', 'history_retention_days', fallback=365)
+HISTORY_COMPACTION_CHUNK = CFG.getint('settings', 'history_compaction_chunk', fallback=500)
+
+DAY = 24 * 60 * 60
+HOUR = 60 * 60
+
+# Ordered by severity so a downsampled bucket keeps the worst availability seen.
+STOCK_UNKNOWN = 0
+STOCK_IN_STOCK = 1
+STOCK_OTHER = 2
+STOCK_LOW = 3
+STOCK_OUT = 4
+
+
+def stock_code(stock):
+    if not stock:
+        return STOCK_UNKNOWN
+
+    stock = stock.lower()
+    if 'out of stock' in stock or 'unavailable' in stock:
+        return STOCK_OUT
+    if 'only' in stock and 'left' in stock:
+        return STOCK_LOW
+    if 'in stock' in stock:
+        return STOCK_IN_STOCK
+
+    return STOCK_OTHER
+
+def history_row(product_obj, recorded_at=None):
+    return {
+        'product_id': product_obj.id,
+        'recorded_at': int(recorded_at or time.time()),
+        'price_cents': product_obj.price_cents,
+        'stock': stock_code(product_obj.stock)
+    }
+
+def price_weight():
+    # Out-of-stock observations carry no price, so averages only count the
+    # samples that had one.
+    return case((PriceHistory.price_cents.isnot(None), func.coalesce(PriceHistory.priced_samples, 1)))
+
+def window_stats_stmt(product_id, since):
+    weight = price_weight()
+
+    return select(
+        func.min(func.coalesce(PriceHistory.min_cents, PriceHistory.price_cents)),
+        func.max(func.coalesce(PriceHistory.max_cents, PriceHistory.price_cents)),
+        func.sum(PriceHistory.price_cents * weight) * 1.0 / func.sum(weight),
+        func.sum(weight)
+    ).where(PriceHistory.product_id == product_id, PriceHistory.recorded_at >= since, PriceHistory.price_cents.isnot(None))
+
+async def price_stats(product_id, days=30, now=None):
+    since = int(now or time.time()) - days * DAY
+
+    async_session = make_session()
+    async with async_session() as session:
+        result = await session.execute(window_stats_stmt(product_id, since))
+        min_cents, max_cents, avg_cents, samples = result.one()
+
+    return {
+        'min_cents': min_cents,
+        'max_cents': max_cents,
+        'avg_cents': round(avg_cents) if avg_cents is not None else None,
+        'samples': samples or 0
+    }
+
+async def is_lowest_in_window(product_obj, days=30):
+    stats = await price_stats(product_obj.id, days)
+    return product_obj.price_cents is not None and stats['min_cents'] is not None and product_obj.price_cents <= stats['min_cents']
+
+def downsample(session, span, older_than, newer_than, first_id, last_id):
+    # Only whole buckets are compacted, so a bucket is never written twice.
+    older_than = older_than // span * span
+    newer_than = newer_than // span * span
+    bucket = (PriceHistory.recorded_at / span) * span
+    weight = func.coalesce(PriceHistory.samples, 1)
+    priced = price_weight()
+    in_range = and_(
+        PriceHistory.product_id.between(first_id, last_id),
+        PriceHistory.recorded_at < older_than,
+        PriceHistory.recorded_at >= newer_than,
+        func.coalesce(PriceHistory.span, 0) < span
+    )
+
+    stmt = select(
+        PriceHistory.product_id,
+        bucket,
+        func.sum(PriceHistory.price_cents * priced) / func.sum(priced),
+        func.max(PriceHistory.stock),
+        func.min(func.coalesce(PriceHistory.min_cents, PriceHistory.price_cents)),
+        func.max(func.coalesce(PriceHistory.max_cents, PriceHistory.price_cents)),
+        func.sum(weight),
+        func.coalesce(func.sum(priced), 0)
+    ).where(in_range).group_by(PriceHistory.product_id, bucket)
+
+    rows = [
+        {'product_id': product_id, 'recorded_at': recorded_at, 'price_cents': price_cents, 'stock': stock, 'min_cents': min_cents, 'max_cents': max_cents, 'samples': samples, 'priced_samples': priced_samples, 'span': span}
+        for product_id, recorded_at, price_cents, stock, min_cents, max_cents, samples, priced_samples in session.execute(stmt)
+    ]
+
+    if rows:
+        session.execute(delete(PriceHistory).where(in_range).execution_options(synchronize_session=False))
+        session.execute(insert(PriceHistory), rows)
+
+    return len(rows)
+
+def compact_price_history(now=None):
+    now = int(now or time.time())
+    raw_cutoff = now - HISTORY_RAW_DAYS * DAY
+    hourly_cutoff = now - HISTORY_HOURLY_DAYS * DAY
+    retention_cutoff = now - HISTORY_RETENTION_DAYS * DAY
+    stats = {'hourly_buckets': 0, 'daily_buckets': 0, 'expired': 0}
+
+    sync_session = make_session(_sync=True)
+    with sync_session() as session:
+        last_id = session.execute(select(func.max(PriceHistory.product_id))).scalar() or 0
+
+    # Each chunk of products is its own short transaction, so the updater is
+    # never locked out for the whole compaction.
+    for first_id in range(0, last_id + 1, HISTORY_COMPACTION_CHUNK):
+        chunk_last_id = first_id + HISTORY_COMPACTION_CHUNK - 1
+
+        with sync_session() as session:
+            stats['hourly_buckets'] += downsample(session, HOUR, raw_cutoff, hourly_cutoff, first_id, chunk_last_id)
+            stats['daily_buckets'] += downsample(session, DAY, hourly_cutoff, retention_cutoff, first_id, chunk_last_id)
+
+            expired = session.execute(delete(PriceHistory).where(
+                PriceHistory.product_id.between(first_id, chunk_last_id),
+                PriceHistory.recorded_at < retention_cutoff
+            ).execution_options(synchronize_session=False))
+            orphaned = session.execute(delete(PriceHistory).where(
+                PriceHistory.product_id.between(first_id, chunk_last_id),
+                not_(exists().where(Product.id == PriceHistory.product_id))
+            ).execution_options(synchronize_session=False))
+            stats['expired'] += expired.rowcount + orphaned.rowcount
+
+            session.commit()
+
+    return stats
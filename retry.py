@@ -0,0 +1,67 @@
+import random
+import asyncio
+
+from datetime import timedelta
+
+from metrics import register_collector, log_event
+
+
+_POLICIES = {}
+
+
+class RetryPolicy:
+    def __init__(self, name, max_retries, base_delay, max_delay, deadline, give_up_on=(), retry_on=(Exception,)):
+        self.name = name
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.give_up_on = tuple(give_up_on)
+        self.retry_on = tuple(retry_on)
+        self.stats = {'calls': 0, 'retries': 0, 'gave_up': 0, 'retry_after_honoured': 0}
+
+        _POLICIES[name] = self
+
+    def next_delay(self, attempt, error):
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            self.stats['retry_after_honoured'] += 1
+            return float(retry_after) + random.uniform(0, self.base_delay)
+
+        # Exponential backoff with full jitter, so concurrent failures spread out.
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        attempt = 0
+        self.stats['calls'] += 1
+
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except self.give_up_on:
+                self.stats['gave_up'] += 1
+                raise
+            except self.retry_on as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.stats['gave_up'] += 1
+                    raise
+
+                delay = self.next_delay(attempt, e)
+                if loop.time() - started + delay > self.deadline:
+                    self.stats['gave_up'] += 1
+                    raise
+
+                self.stats['retries'] += 1
+                log_event('retrying', policy=self.name, attempt=attempt, max_retries=self.max_retries, delay=round(delay, 1), error=str(e))
+                await asyncio.sleep(delay)
+
+
+def retry_stats():
+    return {name: dict(policy.stats) for name, policy in _POLICIES.items()}
+
+register_collector('retry', retry_stats)
@@ -0,0 +1,86 @@
+import time
+import asyncio
+import traceback
+
+from urllib.parse import urlsplit
+
+from metrics import inc, log_event
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def try_acquire(self):
+        # Takes a token if one is available, else returns the seconds until one is.
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                wait = self.try_acquire()
+                if not wait:
+                    return
+
+                await asyncio.sleep(wait)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def host_of(url):
+    return urlsplit(url).hostname or ''
+
+async def run_bounded(items, worker, concurrency, rate_per_host, burst, key=host_of, get_url=lambda item: item.url):
+    items = iter(items)
+    buckets = {}
+    latencies = []
+    summary = {'checked': 0, 'changed': 0, 'failed': 0}
+    started = time.monotonic()
+
+    async def consume():
+        for item in items:
+            bucket_key = key(get_url(item))
+            if bucket_key not in buckets:
+                buckets[bucket_key] = TokenBucket(rate_per_host, burst)
+            await buckets[bucket_key].acquire()
+
+            task_started = time.monotonic()
+            try:
+                changed = await worker(item)
+            except Exception as e:
+                # One bad product must not abort the rest of the run.
+                summary['failed'] += 1
+                inc('updater_check_failures')
+                log_event('check_failed', url=get_url(item), error=str(e), traceback=traceback.format_exc())
+                continue
+            finally:
+                latencies.append(time.monotonic() - task_started)
+                summary['checked'] += 1
+
+            if changed:
+                summary['changed'] += 1
+
+    await asyncio.gather(*(consume() for _ in range(max(1, concurrency))))
+
+    summary['duration'] = time.monotonic() - started
+    summary['p50_latency'] = percentile(latencies, 50)
+    summary['p95_latency'] = percentile(latencies, 95)
+    return summary
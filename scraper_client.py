@@ -0,0 +1,45 @@
+import asyncio
+import aiohttp
+import configparser
+
+
+CFG = configparser.ConfigParser()
+CFG.read('config.ini')
+SCRAPER_CONNECTION_LIMIT = CFG.getint('settings', 'scraper_connection_limit', fallback=100)
+SCRAPER_CONNECTION_LIMIT_PER_HOST = CFG.getint('settings', 'scraper_connection_limit_per_host', fallback=10)
+SCRAPER_DNS_CACHE_TTL = CFG.getint('settings', 'scraper_dns_cache_ttl', fallback=300)
+SCRAPER_KEEPALIVE_TIMEOUT = CFG.getint('settings', 'scraper_keepalive_timeout', fallback=30)
+SCRAPER_REQUEST_TIMEOUT = CFG.getint('settings', 'scraper_request_timeout', fallback=30)
+
+_SESSION = None
+_SESSION_LOOP = None
+
+
+def get_client_session():
+    global _SESSION, _SESSION_LOOP
+    loop = asyncio.get_running_loop()
+
+    # A session is bound to the loop it was created on; the Celery updater
+    # runs a fresh loop per cycle, so a session left over from a previous
+    # loop is dropped rather than reused.
+    if _SESSION is None or _SESSION.closed or _SESSION_LOOP is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=SCRAPER_CONNECTION_LIMIT,
+            limit_per_host=SCRAPER_CONNECTION_LIMIT_PER_HOST,
+            ttl_dns_cache=SCRAPER_DNS_CACHE_TTL,
+            keepalive_timeout=SCRAPER_KEEPALIVE_TIMEOUT
+        )
+        timeout = aiohttp.ClientTimeout(total=SCRAPER_REQUEST_TIMEOUT)
+        _SESSION = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _SESSION_LOOP = loop
+
+    return _SESSION
+
+async def close_client_session():
+    global _SESSION, _SESSION_LOOP
+
+    if _SESSION is not None and not _SESSION.closed and _SESSION_LOOP is asyncio.get_running_loop():
+        await _SESSION.close()
+
+    _SESSION = None
+    _SESSION_LOOP = None
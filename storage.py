@@ -0,0 +1,56 @@
+import configparser
+
+from sqlalchemy import event, insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects import postgresql
+
+
+CFG = configparser.ConfigParser()
+CFG.read('config.ini')
+SQLITE_PRAGMAS = {
+    'journal_mode': CFG.get('settings', 'sqlite_journal_mode', fallback='WAL'),
+    'synchronous': CFG.get('settings', 'sqlite_synchronous', fallback='NORMAL'),
+    'busy_timeout': CFG.getint('settings', 'sqlite_busy_timeout', fallback=5000),
+    'mmap_size': CFG.getint('settings', 'sqlite_mmap_size', fallback=256 * 1024 * 1024),
+    # Negative sizes are KiB rather than pages.
+    'cache_size': CFG.getint('settings', 'sqlite_cache_size', fallback=-64 * 1024)
+}
+
+
+def database_uri(_sync=False):
+    # A full URI (e.g. postgresql+asyncpg://...) replaces the SQLite file
+    # settings; the sync URI is what Celery's clean-up and migrations use.
+    uri = CFG.get('credentials', 'db_sync_uri' if _sync else 'db_uri', fallback=None)
+    if uri:
+        return uri
+
+    prefix = CFG['credentials']['db_sync_uri_prefix' if _sync else 'db_async_uri_prefix']
+    return f"{prefix}/{CFG['credentials']['db_file']}"
+
+def backend_name(db_uri=None):
+    return make_url(db_uri or database_uri(_sync=True)).get_backend_name()
+
+def is_sqlite(db_uri=None):
+    return backend_name(db_uri) == 'sqlite'
+
+def apply_sqlite_pragmas(engine):
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+def configure_engine(engine, db_uri):
+    if is_sqlite(db_uri):
+        apply_sqlite_pragmas(engine)
+
+def insert_ignore(table):
+    backend = backend_name()
+
+    if backend == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if backend == 'mysql':
+        return insert(table).prefix_with('IGNORE')
+
+    return insert(table).prefix_with('OR IGNORE')
@@ -0,0 +1,75 @@
+import random
+import string
+import asyncio
+import itertools
+
+import pytest
+
+from asin_parser import parse_asin, url_asin, is_short_link, extract_asins
+
+
+RNG = random.Random(19)
+ASINS = ['B07PGL2ZSL', '0439708184'] + [''.join(RNG.choice(string.ascii_uppercase + string.digits) for _ in range(10)) for _ in range(8)]
+HOSTS = [
+    'amazon.com', 'www.amazon.com', 'smile.amazon.com', 'm.amazon.com', 'www.amazon.co.uk', 'www.amazon.de',
+    'www.amazon.co.jp', 'www.amazon.com.au', 'www.amazon.com.br', 'www.amazon.in', 'www.amazon.com.mx', 'www.amazon.ca',
+    'www.amazon.COM', 'WWW.AMAZON.COM', 'www.Amazon.co.UK'
+]
+SCHEMES = ['https://', 'http://', 'HTTPS://', '']
+PATHS = ['/dp/{asin}', '/gp/product/{asin}', '/gp/aw/d/{asin}', '/exec/obidos/ASIN/{asin}', '/o/ASIN/{asin}', '/Some-Product-Name/dp/{asin}']
+SUFFIXES = ['', '/', '/ref=sr_1_1', '?th=1&psc=1', '/ref=sr_1_1?keywords=usb+cable&qid=1', '#reviews']
+
+
+def generated_urls(count=400):
+    cases = list(itertools.product(ASINS, SCHEMES, HOSTS, PATHS, SUFFIXES))
+    return RNG.sample(cases, count)
+
+
+@pytest.mark.parametrize('asin', ASINS)
+def test_bare_asin(asin):
+    assert parse_asin(asin) == asin
+
+@pytest.mark.parametrize('asin, scheme, host, path, suffix', generated_urls())
+def test_product_urls(asin, scheme, host, path, suffix):
+    url = scheme + host + path.format(asin=asin) + suffix
+
+    assert parse_asin(url) == asin
+    assert url_asin(url) == asin
+
+@pytest.mark.parametrize('text', [
+    'b07pgl2zsl',
+    'B07PGL2ZS',
+    'B07PGL2ZSL1',
+    'B07PGL2ZS!',
+    '',
+    'https://www.amazon.com/',
+    'https://www.amazon.com/dp/',
+    'https://www.amazon.com/dp/B07PGL2ZS',
+    'https://www.amazon.com/dp/B07PGL2ZSLX',
+    'https://www.amazon.com/dp/b07pgl2zsl',
+    'https://www.amazon.com/s?k=B07PGL2ZSL',
+    'https://www.ebay.com/dp/B07PGL2ZSL',
+    'https://evil.com/amazon.com/dp/B07PGL2ZSL',
+    'https://www.amazon.com.evil.example/dp/B07PGL2ZSL',
+    'ftp://www.amazon.com/dp/B07PGL2ZSL',
+    'not a url at all',
+])
+def test_rejects(text):
+    assert parse_asin(text) is None
+
+@pytest.mark.parametrize('text, expected', [
+    ('https://amzn.to/3abcDEF', True),
+    ('amzn.to/3abcDEF', True),
+    ('https://a.co/d/abc123', True),
+    ('HTTPS://AMZN.EU/d/xyz', True),
+    ('https://amzn.to/', False),
+    ('https://www.amazon.com/dp/B07PGL2ZSL', False),
+    ('https://notamzn.to/3abcDEF', False),
+])
+def test_short_links(text, expected):
+    assert is_short_link(text) is expected
+
+def test_extract_asins_keeps_order():
+    args = ['B07PGL2ZSL', 'nonsense', 'https://www.amazon.co.uk/dp/0439708184/ref=x', 'https://www.ebay.com/dp/B07PGL2ZSL']
+
+    assert asyncio.run(extract_asins(args)) == ['B07PGL2ZSL', None, '0439708184', None]
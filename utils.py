@@ -1,129 +1,234 @@
 import re
-import aiohttp
+import asyncio
 import configparser
 
-from bs4 import BeautifulSoup
-from time import sleep
-from datetime import datetime
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram._bot import Bot
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest, Forbidden
+
+from retry import RetryPolicy
+from parse_pool import extract_fields
+from fingerprints import region_fingerprint, conditional_headers, record
+from scraper_client import get_client_session
+from messages import construct_message
+from asin_parser import url_asin
+from metrics import timer, inc, log_event
 
 
 CFG = configparser.ConfigParser()
 CFG.read('config.ini')
 URL_PREFIX = CFG['settings']['url_prefix']
 URL_SUFFIX = CFG['settings']['url_suffix']
-PRODUCT_TITLE = CFG['selectors']['product_title']
-PRODUCT_PRICE = CFG['selectors']['product_price']
-PRODUCT_STOCK = CFG['selectors']['product_stock']
 TOKEN = CFG['credentials']['token']
+TELEGRAM_BASE_URL = CFG.get('settings', 'telegram_base_url', fallback='https://api.telegram.org/bot')
+# One connection per dispatcher worker, so concurrent sends don't queue on the pool.
+TELEGRAM_POOL_SIZE = CFG.getint('settings', 'dispatch_workers', fallback=8)
 RETRY_MESSAGING_INTERVAL = int(CFG['settings']['retry_messaging_interval'])
 RETRY_SCRAPING_INTERVAL = int(CFG['settings']['retry_scraping_interval'])
 MAX_MESSAGING_RETRY = int(CFG['settings']['max_messaging_retry'])
 MAX_SCRAPING_RETRY = int(CFG['settings']['max_scraping_retry'])
+CURRENCY_CODE = re.compile(r'\b(USD|CAD|GBP|EUR|JPY|INR|AUD|MXN|BRL)\b')
+# Longer prefixes come first, so "CDN$" and "CA$" aren't read as "$" or "A$".
+CURRENCY_SYMBOLS = (
+    ('CDN$', 'CAD'), ('CA$', 'CAD'), ('AU$', 'AUD'), ('MX$', 'MXN'), ('US$', 'USD'),
+    ('C$', 'CAD'), ('A$', 'AUD'), ('R$', 'BRL'), ('$', 'USD'), ('£', 'GBP'), ('€', 'EUR'), ('¥', 'JPY'), ('₹', 'INR')
+)
+PRICE_AMOUNT = re.compile(r'(?:\d|[.,]\d)[\d.,\s\u00a0]*')
+RETRY_MAX_DELAY = CFG.getfloat('settings', 'retry_max_delay', fallback=60)
+RETRY_MESSAGING_DEADLINE = CFG.getfloat('settings', 'retry_messaging_deadline', fallback=120)
+RETRY_SCRAPING_DEADLINE = CFG.getfloat('settings', 'retry_scraping_deadline', fallback=120)
+
+MESSAGING_RETRY = RetryPolicy('messaging', MAX_MESSAGING_RETRY, RETRY_MESSAGING_INTERVAL, RETRY_MAX_DELAY, RETRY_MESSAGING_DEADLINE, give_up_on=(BadRequest, Forbidden))
+SCRAPING_RETRY = RetryPolicy('scraping', MAX_SCRAPING_RETRY, RETRY_SCRAPING_INTERVAL, RETRY_MAX_DELAY, RETRY_SCRAPING_DEADLINE)
+
+_BOT = None
+_BOT_LOOP = None
+_BOT_READY = None
 
 
 def construct_url(asin):
     return URL_PREFIX + str(asin) + URL_SUFFIX
 
-def elapsed_time(start_time):
-    to_str = ''
-    interval = (datetime.now() - start_time).seconds
+async def get_bot():
+    global _BOT, _BOT_LOOP, _BOT_READY
+    loop = asyncio.get_running_loop()
 
-    if interval // (60*60*24*365) > 0:
-        to_str += f"{ interval // (60*60*24*365) }yr "
+    # Like the scraper session, the bot's HTTP client belongs to one loop.
+    if _BOT is None or _BOT_LOOP is not loop or _BOT_READY.done() and _BOT_READY.exception() is not None:
+        _BOT = Bot(token=TOKEN, base_url=TELEGRAM_BASE_URL, request=HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
+        _BOT_LOOP = loop
+        _BOT_READY = asyncio.ensure_future(_BOT.initialize())
 
-    if interval // (60*60*24) > 0:
-        to_str += f"{ (interval // (60*60*24))%365 }day "
+    await _BOT_READY
+    return _BOT
 
-    if interval // (60*60) > 0:
-        to_str += f"{ (interval // (60*60))%(24) }hr "
+async def close_bot():
+    global _BOT, _BOT_LOOP, _BOT_READY
 
-    if interval // (60) > 0:
-        to_str += f"{ (interval // (60))%(60) }min(s) ago"
+    if _BOT is not None and _BOT_LOOP is asyncio.get_running_loop():
+        await _BOT.shutdown()
 
-    if interval // 60 == 0:
-        to_str += f"just now"
+    _BOT = _BOT_LOOP = _BOT_READY = None
 
-    return to_str
+def product_keyboard(*asins):
+    # The ASIN rides along as callback data, so replies and button presses
+    # resolve the product without parsing the message text.
+    if len(asins) == 1:
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton('Update', callback_data=f'u:{asins[0]}'),
+            InlineKeyboardButton('Stop', callback_data=f's:{asins[0]}')
+        ]])
 
-def construct_message(obj, old_price=None, auto_update=False, restart_updates=False, notify_admin=False, stock_update=False):
-    title = obj.title if obj.title != '' else 'No information...'
-    price = obj.price if obj.price != '' else 'No information...'
-    stock = obj.stock if obj.stock != '' else 'No information...'
-    url = obj.url
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f'Update {asin}', callback_data=f'u:{asin}'),
+        InlineKeyboardButton(f'Stop {asin}', callback_data=f's:{asin}')
+    ] for asin in asins])
 
-    time_since = elapsed_time(obj.last_checked)
+def restart_keyboard(asin):
+    return InlineKeyboardMarkup([[InlineKeyboardButton('Restart', callback_data=f'r:{asin}')]])
 
-    if auto_update:
-        if old_price not in [None, '']:
-            return f'Update Alert! Price updated.\nLast checked: { time_since }\n\nTitle: { title }\n\nStock Status: { stock }\nPrevious Price: { old_price }\nUpdated Price: { price }\n\nBuy Now: { url }\n\n'
-        elif stock_update:
-            return f'Update Alert! Stock updated.\nLast checked: { time_since }\n\nTitle: { title }\n\nStock Status: { stock }\nPrevious Price: { old_price }\nUpdated Price: { price }\n\nBuy Now: { url }\n\n'
-        else:
-            return f'Update Alert! Price updated.\nLast checked: { time_since }\n\nTitle: { title }\n\nStock Status: { stock }\nPrice: { price }\n\nBuy Now: { url }\n\n'
+def keyboard_asins(reply_markup):
+    asins = []
 
-    if restart_updates:
-        return f"Tracking Restarted!\nLast checked: { time_since }\n\nTitle: { title }\n\nStock Status: { stock }\nPrice: { price }\n\nBuy Now: { url }\n\n"
+    for row in reply_markup.inline_keyboard:
+        for button in row:
+            action, _, asin = (button.callback_data or '').partition(':')
+            if action in ('u', 's', 'r') and asin and asin not in asins:
+                asins.append(asin)
 
-    if notify_admin:
-        return f"Admin Notification!\nLast checked: { time_since }\n\nTitle: { title }\n\nStock Status: { stock }\nPrice: { price }\n\nBuy Now: { url }\n\n"
+    return asins
 
-    return f"Last checked: { time_since }\n\nTitle: { title }\n\nStock Status: { stock }\nPrice: { price }\n\nBuy Now: { url }\n\n"
+async def send_once(chat_id, msg, reply_markup=None):
+    bot = await get_bot()
+    with timer('telegram_send'):
+        await bot.send_message(chat_id=chat_id, text=msg, reply_markup=reply_markup)
 
-async def send(chat_id, msg):
-    retries = 0
-    while retries <= MAX_MESSAGING_RETRY:
-        try:
-            async with Bot(token=TOKEN) as bot:
-                await bot.send_message(chat_id=chat_id, text=msg)
-                return
-        except Exception as e:
-            retries += 1
-            print(f"Failed to send message: {e}\nRetrying in {RETRY_MESSAGING_INTERVAL} seconds ({retries}/{MAX_MESSAGING_RETRY})")
-            sleep(RETRY_MESSAGING_INTERVAL)
+async def send(chat_id, msg, reply_markup=None):
+    try:
+        await MESSAGING_RETRY.run(send_once, chat_id, msg, reply_markup=reply_markup)
+    except Exception as e:
+        inc('telegram_send_failures')
+        log_event('send_failed', chat_id=chat_id, error=str(e))
 
 async def send_message(chat_id, obj, old_price=None, auto_update=False, restart_updates=False, notify_admin=False, stock_update=False):
     msg = construct_message(obj, old_price=old_price, auto_update=auto_update, restart_updates=restart_updates, notify_admin=notify_admin, stock_update=stock_update)
-    await send(chat_id, msg)
+    await send(chat_id, msg, reply_markup=product_keyboard(obj.asin))
+
+async def fetch_product_data(url, asin=None, validator=None):
+    session = get_client_session()
+    with timer('scrape_fetch'):
+        async with session.get(url, headers=conditional_headers(validator)) as response:
+            if response.status == 304:
+                record('not_modified')
+                return {'asin': asin, 'url': url, 'unchanged': True, 'validator': validator}
+
+            # Throttling and outage pages are retried rather than parsed into
+            # a product with no title.
+            if response.status >= 500:
+                response.raise_for_status()
+
+            body = await response.read()
+            encoding = response.get_encoding()
+            new_validator = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fingerprint': region_fingerprint(body)
+            }
+
+    if validator is not None:
+        if new_validator['fingerprint'] is not None and new_validator['fingerprint'] == validator.get('fingerprint'):
+            record('fingerprint_hits')
+            return {'asin': asin, 'url': url, 'unchanged': True, 'validator': new_validator}
+
+        record('misses')
+
+    with timer('scrape_parse'):
+        fields = await extract_fields(body, encoding)
+    data = product_data(fields, asin, url)
+    data['validator'] = new_validator
+
+    return data
+
+def product_data(fields, asin, url):
+    data = {'asin': asin, 'url': url, **fields}
+
+    missing = [field for field in ('title', 'price', 'stock') if data[field] is None]
+    if missing:
+        log_event('fields_missing', asin=asin, url=url, missing=missing)
+
+    return data
 
-async def get_data(asin=None, url=None):
+async def get_data(asin=None, url=None, validator=None):
     if url is None:
         url = construct_url(asin)
 
-    retries = 0
-    while retries <= MAX_SCRAPING_RETRY:
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    html = await response.text()
-                    soup = BeautifulSoup(html, 'html.parser')
-                    data = {
-                        'title': None,
-                        'asin': asin,
-                        'price': None,
-                        'stock': None,
-                        'url': url
-                    }
-
-                    try:
-                        data['title'] = soup.select_one(PRODUCT_TITLE).text.strip()
-                        data['price'] = soup.select_one(PRODUCT_PRICE).text.strip()
-                        data['stock'] = soup.select_one(PRODUCT_STOCK).text.strip()
-                    except Exception as e:
-                        print(e)
-
-            return data
-
-        except Exception as e:
-            retries += 1
-            print(f"Failed to send message: {e}\nRetrying in {RETRY_SCRAPING_INTERVAL} seconds ({retries}/{MAX_SCRAPING_RETRY})")
-            sleep(RETRY_SCRAPING_INTERVAL)
-
-def get_comparable_price(raw_price):
     try:
-        return float(raw_price.strip('$').strip())
-    except:
-        return -1
+        return await SCRAPING_RETRY.run(fetch_product_data, url, asin=asin, validator=validator)
+    except Exception as e:
+        inc('scrape_failures')
+        log_event('scrape_failed', url=url, error=str(e))
+
+def parse_price(raw_price):
+    if not raw_price:
+        return None, None
+
+    currency = None
+    code = CURRENCY_CODE.search(raw_price)
+    if code:
+        currency = code.group(0)
+    else:
+        for symbol, symbol_currency in CURRENCY_SYMBOLS:
+            if symbol in raw_price:
+                currency = symbol_currency
+                break
+
+    # Ranges like "$10.99 - $19.99" compare on their low end.
+    amount = PRICE_AMOUNT.search(raw_price)
+    if amount is None:
+        return None, currency
+
+    number = amount.group(0).rstrip(' .,\u00a0')
+    decimal_at = max(number.rfind('.'), number.rfind(','))
+
+    # The rightmost separator is the decimal mark, unless it is the only kind
+    # present and either repeats ("1,234,567") or is followed by exactly three
+    # digits ("1,299"), in which case it separates thousands. A leading mark
+    # (".99") is always decimal.
+    if decimal_at > 0:
+        mark = number[decimal_at]
+        other = ',' if mark == '.' else '.'
+        if other not in number and (number.count(mark) > 1 or len(number) - decimal_at - 1 == 3):
+            decimal_at = -1
+
+    if decimal_at == -1:
+        whole, fraction = number, ''
+    else:
+        whole, fraction = number[:decimal_at], number[decimal_at + 1:]
+
+    whole = re.sub(r'[^\d]', '', whole) or '0'
+    fraction = (fraction + '00')[:2]
+
+    return int(whole) * 100 + int(fraction), currency
+
+def set_price(product_obj, raw_price, price_cents=None, currency=None):
+    if price_cents is None and currency is None:
+        price_cents, currency = parse_price(raw_price)
+
+    old_cents = product_obj.price_cents
+    product_obj.price = raw_price
+    product_obj.price_cents = price_cents
+    product_obj.currency = currency or product_obj.currency
+    product_obj.previous_price_cents = old_cents if old_cents is not None else price_cents
+    product_obj.price_change_bp = price_change_bp(product_obj.previous_price_cents, price_cents)
+
+    return product_obj
+
+def price_change_bp(old_cents, new_cents):
+    if not old_cents or new_cents is None:
+        return 0
+
+    return round((new_cents - old_cents) * 10000 / old_cents)
 
 def extract_url_from_message(msg, stop_msg=False):
     if stop_msg:
@@ -133,7 +238,7 @@ def extract_url_from_message(msg, stop_msg=False):
 
 def extract_data_from_message(msg, stop_msg=False):
     url = extract_url_from_message(msg, stop_msg)
-    asin = re.findall(r'/dp/([A-Z0-9]{10})/', url)[0]
+    asin = url_asin(url)
 
     return {'asin': asin, 'url': url}
 
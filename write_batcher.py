@@ -0,0 +1,173 @@
+import asyncio
+import configparser
+
+from sqlalchemy import update, bindparam
+from sqlalchemy.exc import OperationalError, InterfaceError
+
+from retry import RetryPolicy
+from storage import insert_ignore
+from metrics import log_event
+
+
+CFG = configparser.ConfigParser()
+CFG.read('config.ini')
+BATCH_FLUSH_SIZE = CFG.getint('settings', 'batch_flush_size', fallback=500)
+BATCH_FLUSH_INTERVAL = CFG.getfloat('settings', 'batch_flush_interval', fallback=2)
+BATCH_MAX_PENDING = CFG.getint('settings', 'batch_max_pending', fallback=5000)
+BATCH_WRITE_RETRIES = CFG.getint('settings', 'batch_write_retries', fallback=5)
+BATCH_WRITE_DEADLINE = CFG.getfloat('settings', 'batch_write_deadline', fallback=60)
+
+# A locked or unreachable database fails every row alike, so those errors are
+# retried as a whole batch rather than bisected.
+WRITE_RETRY = RetryPolicy('batch_write', BATCH_WRITE_RETRIES, 0.5, 8, BATCH_WRITE_DEADLINE, retry_on=(OperationalError, InterfaceError))
+
+
+class WriteBatcher:
+    def __init__(self, session_factory, table, key='id', append=False, flush_size=BATCH_FLUSH_SIZE, flush_interval=BATCH_FLUSH_INTERVAL, max_pending=BATCH_MAX_PENDING):
+        self.session_factory = session_factory
+        self.table = table
+        self.key = key
+        self.append = append
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.stats = {'rows': 0, 'flushes': 0, 'statements': 0, 'failed_rows': 0}
+        self.failed = set()
+        self.task = None
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def put(self, row):
+        # Blocks producers once max_pending rows are waiting, which bounds memory.
+        await self.queue.put(row)
+
+    async def barrier(self):
+        # Resolves once every row put before it has been flushed, with the
+        # keys of the rows that could not be written so far.
+        written = asyncio.get_running_loop().create_future()
+        await self.queue.put(written)
+        return await written
+
+    def release(self, barrier):
+        if not barrier.done():
+            barrier.set_result(frozenset(self.failed))
+
+    async def run(self):
+        while True:
+            row = await self.queue.get()
+            if row is None:
+                return
+            if isinstance(row, asyncio.Future):
+                self.release(row)
+                continue
+
+            rows = [row]
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            closing = False
+            barrier = None
+
+            while len(rows) < self.flush_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    closing = True
+                    break
+                if isinstance(row, asyncio.Future):
+                    barrier = row
+                    break
+                rows.append(row)
+
+            await self.safe_flush(rows)
+            if barrier is not None:
+                self.release(barrier)
+            if closing:
+                return
+
+    async def safe_flush(self, rows):
+        try:
+            await WRITE_RETRY.run(self.flush, rows)
+        except (OperationalError, InterfaceError) as e:
+            self.fail(rows, e)
+        except Exception as e:
+            # Halving the batch narrows a data error down to the rows that
+            # cause it; those keep their old next_check, so the next run
+            # retries them.
+            if len(rows) > 1:
+                middle = len(rows) // 2
+                await self.safe_flush(rows[:middle])
+                await self.safe_flush(rows[middle:])
+                return
+
+            self.fail(rows, e)
+
+    def fail(self, rows, error):
+        self.stats['failed_rows'] += len(rows)
+        self.failed.update(row[self.key] for row in rows if self.key in row)
+        log_event('batch_write_failed', table=self.table.name, rows=len(rows), first=rows[0], error=str(error))
+
+    async def flush(self, rows):
+        # executemany needs one parameter shape per statement, so rows are
+        # grouped by the set of columns they touch.
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+
+        async with self.session_factory() as session:
+            for columns, group in groups.items():
+                if self.append:
+                    stmt, params = insert_ignore(self.table), group
+                else:
+                    stmt, params = self.update_statement(columns, group)
+
+                await session.execute(stmt, params)
+                self.stats['statements'] += 1
+
+            await session.commit()
+
+        self.stats['rows'] += len(rows)
+        self.stats['flushes'] += 1
+
+    def update_statement(self, columns, group):
+        stmt = update(self.table).where(self.table.c[self.key] == bindparam(f'_{self.key}')).values(
+            {column: bindparam(column) for column in columns if column != self.key}
+        )
+        params = []
+        for row in group:
+            param = dict(row)
+            param[f'_{self.key}'] = param.pop(self.key)
+            params.append(param)
+
+        return stmt, params
+
+    async def close(self):
+        if self.task is None:
+            return
+
+        if not self.task.done():
+            await self.queue.put(None)
+        await self.task
+        self.task = None
+
+        # Rows queued after the sentinel are still written before the run ends.
+        leftover = []
+        barriers = []
+        while not self.queue.empty():
+            row = self.queue.get_nowait()
+            if isinstance(row, asyncio.Future):
+                barriers.append(row)
+            elif row is not None:
+                leftover.append(row)
+        if leftover:
+            await self.safe_flush(leftover)
+        for barrier in barriers:
+            self.release(barrier)